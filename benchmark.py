@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Benchmarks for metaconfig.py.
+#
+# Generates a synthetic metaconfig repository and home directory in a
+# temporary directory, runs a non-interactive install and reports the wall
+# time, number of filesystem calls and peak memory of every phase.
+#
+# Licence: MIT, see metaconfig.py
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import collections
+
+import metaconfig
+
+# Phases of a run, in order.
+PHASES = ["discovery", "load", "plan", "apply"]
+
+def generateRepo(root, options):
+  """Creates a synthetic repository and home directory inside root.
+
+  Every module installs its files in ~/mNNN/. Some of the destinations
+  already have the right symlink, some have a regular file with older
+  backups, and the rest don't exist yet.
+
+  @return: (meta_dir, home)
+  """
+  rng = random.Random(options.seed)
+  meta_dir = os.path.join(root, "repo")
+  home = os.path.join(root, "home")
+  os.makedirs(meta_dir)
+  os.makedirs(home)
+
+  # A large hidden directory, like .git, that discovery should not walk.
+  for i in range(options.hidden_files):
+    path = os.path.join(meta_dir, ".git", "objects", "%02x" % (i % 256))
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "object%06d" % i), "w") as f:
+      f.write("x")
+
+  for m in range(options.modules):
+    name = "m%03d" % m
+    module_dir = os.path.join(meta_dir, name)
+    dest_dir = os.path.join(home, name)
+    os.makedirs(module_dir)
+    os.makedirs(dest_dir)
+    with open(os.path.join(module_dir, "metaconfig.yaml"), "w") as f:
+      f.write("location: ~/" + name + "/\n")
+
+    files = ["file%04d" % i for i in range(options.links)]
+    for filename in files:
+      with open(os.path.join(module_dir, filename), "w") as f:
+        f.write(filename * options.file_size)
+
+    if options.plugin_depth > 0:
+      files.append("plugins")
+      generateTree(os.path.join(module_dir, "plugins"), options)
+
+    for filename in files:
+      source = os.path.join(module_dir, filename)
+      dest = os.path.join(dest_dir, filename)
+      roll = rng.random()
+      if roll < options.installed:
+        os.symlink(source, dest)
+        continue
+      if roll > options.installed + options.existing:
+        continue
+      # Something is in the way, and it was backed up before.
+      copy = shutil.copytree if os.path.isdir(source) else shutil.copy2
+      copy(source, dest)
+      for k in range(1, options.backups + 1):
+        copy(source, dest + ".bak" + str(k))
+  return meta_dir, home
+
+def generateTree(path, options, depth = 0):
+  os.makedirs(path)
+  for i in range(options.plugin_files):
+    with open(os.path.join(path, "plugin%03d.vim" % i), "w") as f:
+      f.write("\" plugin %d\n" % i * options.file_size)
+  if depth + 1 < options.plugin_depth:
+    for i in range(options.plugin_width):
+      generateTree(os.path.join(path, "dir%02d" % i), options, depth + 1)
+
+def runOnce(options):
+  """Generates a repository, installs it and measures every phase."""
+  root = tempfile.mkdtemp(prefix = "metaconfig-bench-")
+  old_home = os.environ.get("HOME")
+  try:
+    meta_dir, home = generateRepo(root, options)
+    os.environ["HOME"] = home
+    with metaconfig.Context.fromOptions("text",
+        state_dir = os.path.join(root, "state"), jobs = options.jobs,
+        no_hash_cache = options.no_hash_cache) as context:
+      results = measure(meta_dir, context, root)
+    return results
+  finally:
+    if old_home is not None:
+      os.environ["HOME"] = old_home
+    if options.keep:
+      print("Kept: " + root, file = sys.stderr)
+    else:
+      shutil.rmtree(root, ignore_errors = True)
+
+def measure(meta_dir, context, root):
+  """Runs every phase with the options of context."""
+  hashes = None
+  if not context.args.no_hash_cache:
+    hashes = metaconfig.HashCache(os.path.join(root, "state", "hashes.json"))
+  configs = metaconfig.ConfigCache()
+
+  results = {}
+  steps = [
+    ("discovery", lambda _: metaconfig.discoverModules(meta_dir)),
+    ("load", lambda discovered: metaconfig.loadModules(discovered, [],
+      configs)),
+    ("plan", lambda modules: metaconfig.planModules(context, meta_dir,
+      hashes, configs = configs, modules = modules)),
+    ("apply", lambda plan: metaconfig.applyPlan(context, plan,
+      context.args.jobs)),
+  ]
+  value = None
+  tracemalloc.start()
+  with open(os.devnull, "w") as devnull, \
+      contextlib.redirect_stdout(devnull), \
+      metaconfig.SyscallCounter() as counter:
+    for phase, step in steps:
+      tracemalloc.reset_peak()
+      counter.reset()
+      start = time.perf_counter()
+      value = step(value)
+      context.output.flush()
+      elapsed = time.perf_counter() - start
+      results[phase] = {"seconds": elapsed, "calls": counter.reset(),
+        "peak_bytes": tracemalloc.get_traced_memory()[1]}
+  tracemalloc.stop()
+  results["apply"]["failed"] = sum(1 for r in value if r != "ok")
+  return results
+
+def printReport(runs):
+  print("%-10s %10s %10s %10s" % ("phase", "seconds", "fs calls", "peak MB"))
+  for phase in PHASES:
+    seconds = min(run[phase]["seconds"] for run in runs)
+    calls = sum(runs[0][phase]["calls"].values())
+    peak = max(run[phase]["peak_bytes"] for run in runs) / 1024.0 / 1024.0
+    print("%-10s %10.4f %10d %10.2f" % (phase, seconds, calls, peak))
+  total = min(sum(run[phase]["seconds"] for phase in PHASES) for run in runs)
+  print("%-10s %10.4f" % ("total", total))
+  print("Best of " + str(len(runs)) + " runs. Top calls per phase:")
+  for phase in PHASES:
+    top = collections.Counter(runs[0][phase]["calls"]).most_common(4)
+    print("  %-10s %s" % (phase,
+      ", ".join(name + "=" + str(n) for name, n in top)))
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+    description = "Benchmark metaconfig.py on a synthetic repository.")
+  parser.add_argument("--modules", type=int, default=20,
+    help = "number of modules.")
+  parser.add_argument("--links", type=int, default=50,
+    help = "number of files in every module.")
+  parser.add_argument("--file-size", type=int, default=10,
+    help = "size of the files, in repetitions of their name.")
+  parser.add_argument("--plugin-depth", type=int, default=0,
+    help = "depth of a plugin directory tree added to every module.")
+  parser.add_argument("--plugin-width", type=int, default=3,
+    help = "subdirectories per level of the plugin tree.")
+  parser.add_argument("--plugin-files", type=int, default=10,
+    help = "files per level of the plugin tree.")
+  parser.add_argument("--backups", type=int, default=3,
+    help = "existing backup generations of every element in the way.")
+  parser.add_argument("--installed", type=float, default=0.5,
+    help = "fraction of the links that are already installed.")
+  parser.add_argument("--existing", type=float, default=0.25,
+    help = "fraction of the destinations that have something in the way.")
+  parser.add_argument("--hidden-files", type=int, default=1000,
+    help = "files in a hidden .git directory in the repository.")
+  parser.add_argument("-j", "--jobs", type=int, default=1,
+    help = "passed to metaconfig.py.")
+  parser.add_argument("--no-hash-cache", default=False, action="store_true",
+    help = "passed to metaconfig.py.")
+  parser.add_argument("--repeat", type=int, default=3,
+    help = "number of runs, the best one is reported.")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--json", default=False, action="store_true",
+    help = "print the results of every run as JSON.")
+  parser.add_argument("--keep", default=False, action="store_true",
+    help = "don't remove the generated directories.")
+  options = parser.parse_args(argv)
+
+  runs = [runOnce(options) for _ in range(options.repeat)]
+  if options.json:
+    json.dump({"options": vars(options), "runs": runs}, sys.stdout, indent = 2)
+    print()
+  else:
+    printReport(runs)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
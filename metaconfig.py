@@ -28,18 +28,28 @@
 import os
 import time
 import sys
-import yaml
+import json
 import os.path
-import readline
-import glob
+import re
 import fnmatch
-import filecmp
 import argparse
 import string
 import shutil
+import threading
+import builtins
+import collections
+import fcntl
+import stat
+import hashlib
+import io
+import contextlib
+import select
+import struct
+import errno
+import heapq
 
-# Arguments to the program
-args = None
+# Slow to import modules like yaml, readline, socket or ctypes are imported
+# where they are needed, so that starting up stays fast.
 
 class TextColors:
     HEADER = '\033[95m'
@@ -49,15 +59,475 @@ class TextColors:
     ERROR = '\033[91m'
     END = '\033[0m'
 
+class Output:
+  """Buffered output for messages and structured log records.
+
+  Messages are collected and written in bulk, either when enough of them are
+  pending or right before the user is prompted. With the "json" log format,
+  one JSON record is written to stdout for every module and action, and
+  messages go to stderr so stdout can be parsed. Without a log format,
+  nothing is written at all.
+  """
+
+  # Number of pending messages that triggers a write.
+  FLUSH_SIZE = 256
+
+  def __init__(self, log_format = "text", typewriter = False, delay = 0.003,
+      profiler = None):
+    """
+    @param profiler: The Profiler that times writes, if any.
+    """
+    self.log_format = log_format
+    self.typewriter = typewriter
+    self.delay = delay
+    self.profiler = profiler
+    self.pending = []
+
+  def message(self, text, end = "\n", error = False):
+    if self.log_format is None:
+      return
+    stream = sys.stderr if self.log_format == "json" else sys.stdout
+    start = TextColors.ERROR if error else ""
+    if self.typewriter:
+      self.flush()
+      stream.write(start)
+      for l in text:
+        stream.write(l)
+        stream.flush()
+        time.sleep(self.delay)
+      stream.write(TextColors.END + end)
+      stream.flush()
+      return
+    self.write(stream, start + text + TextColors.END + end)
+
+  def record(self, **fields):
+    if self.log_format == "json":
+      self.write(sys.stdout, json.dumps(fields, sort_keys = True) + "\n")
+
+  def write(self, stream, text):
+    self.pending.append((stream, text))
+    if len(self.pending) >= self.FLUSH_SIZE:
+      self.flush()
+
+  def flush(self):
+    if not self.pending:
+      return
+    if self.profiler is None:
+      self.writePending()
+      return
+    with self.profiler.span("flush", "output", messages = len(self.pending)):
+      self.writePending()
+
+  def writePending(self):
+    pending, self.pending = self.pending, []
+    streams = []
+    for stream, text in pending:
+      if not streams or streams[-1][0] is not stream:
+        streams.append((stream, []))
+      streams[-1][1].append(text)
+    for stream, texts in streams:
+      stream.write("".join(texts))
+      stream.flush()
+
+  def prompt(self, text = ""):
+    """Shows any pending output and reads a line from the user."""
+    self.message(text, end = "")
+    self.flush()
+    return input()
+
+class SyscallCounter:
+  """Counts calls to the filesystem functions of the os module.
+
+  Functions are replaced while the counter is active, so calls made through
+  os.path, shutil and friends are counted too. Every thread has its own
+  counts, so the calls made by an action running on a worker thread can be
+  told apart from the others.
+  """
+
+  NAMES = ["stat", "lstat", "scandir", "listdir", "readlink", "symlink",
+    "link", "rename", "replace", "remove", "unlink", "rmdir", "mkdir"]
+
+  def __init__(self):
+    self.local = threading.local()
+    self.counters = []
+    self.lock = threading.Lock()
+    self.originals = {}
+
+  def current(self):
+    """Returns the Counter of the calling thread."""
+    counts = getattr(self.local, "counts", None)
+    if counts is None:
+      counts = self.local.counts = collections.Counter()
+      with self.lock:
+        self.counters.append(counts)
+    return counts
+
+  def wrap(self, name, function):
+    def counted(*a, **kw):
+      self.current()[name] += 1
+      return function(*a, **kw)
+    return counted
+
+  def __enter__(self):
+    for name in self.NAMES:
+      self.originals[name] = getattr(os, name)
+      setattr(os, name, self.wrap(name, self.originals[name]))
+    self.originals["open"] = builtins.open
+    builtins.open = self.wrap("open", builtins.open)
+    return self
+
+  def __exit__(self, *exc):
+    builtins.open = self.originals.pop("open")
+    for name, function in self.originals.items():
+      setattr(os, name, function)
+    self.originals = {}
+
+  def snapshot(self, all_threads = False):
+    """Returns a copy of the counts of the calling thread.
+
+    @param all_threads: Add up the counts of every thread instead, for
+      phases that run on worker threads.
+    """
+    if not all_threads:
+      return dict(self.current())
+    total = collections.Counter()
+    with self.lock:
+      for counts in self.counters:
+        total.update(counts)
+    return dict(total)
+
+  def reset(self):
+    """Returns the counts of all threads, and starts over."""
+    total = collections.Counter()
+    with self.lock:
+      for counts in self.counters:
+        total.update(counts)
+        counts.clear()
+    return dict(total)
+
+class Span:
+  """Times a block of code. See Profiler.span()."""
+
+  __slots__ = ["profiler", "name", "category", "fields", "start",
+    "duration", "calls", "before", "thread"]
+
+  def __init__(self, profiler, name, category, fields):
+    self.profiler = profiler
+    self.name = name
+    self.category = category
+    self.fields = fields
+    self.duration = None
+    self.calls = None
+
+  def __enter__(self):
+    if self.profiler is not None:
+      self.thread = threading.get_ident()
+      self.before = self.profiler.counter.snapshot(self.category == "phase")
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.duration = time.perf_counter() - self.start
+    if self.profiler is not None:
+      after = self.profiler.counter.snapshot(self.category == "phase")
+      self.calls = dict((name, n - self.before.get(name, 0))
+        for name, n in after.items() if n != self.before.get(name, 0))
+      self.profiler.add(self)
+
+class Profiler:
+  """Timing and filesystem calls of the phases, modules and links of a run.
+
+  Spans are always timed, but they are only recorded (and calls are only
+  counted) while the profiler is enabled with --profile. Phases count the
+  calls of every thread, everything else only those of its own thread.
+  """
+
+  def __init__(self, enabled = False):
+    self.enabled = enabled
+    self.spans = []
+    self.counter = None
+    self.origin = time.perf_counter()
+    self.lock = threading.Lock()
+
+  def start(self):
+    if self.enabled:
+      self.counter = SyscallCounter().__enter__()
+
+  def stop(self):
+    if self.counter is not None:
+      self.counter.__exit__()
+
+  def span(self, name, category, **fields):
+    """Returns a context manager that times the code it wraps.
+
+    @param name: What is being timed, like a module name or a path.
+    @param category: One of "phase", "module", "link", "action", "compare"
+      or "output".
+    @param fields: Anything else worth keeping in the trace.
+    """
+    return Span(self if self.counter is not None else None, name, category,
+      fields)
+
+  def add(self, span):
+    with self.lock:
+      self.spans.append(span)
+
+  def report(self, top = 10):
+    """Returns the lines of a report with the slowest spans."""
+    lines = ["\n--- Profile ---"]
+    for category in ["phase", "module", "link", "action", "compare",
+        "output"]:
+      spans = [s for s in self.spans if s.category == category]
+      if not spans:
+        continue
+      total = sum(s.duration for s in spans)
+      calls = collections.Counter()
+      for s in spans:
+        calls.update(s.calls)
+      lines.append(category + ": " + str(len(spans)) + " spans, " +
+        "%.4f" % total + " seconds, " + str(sum(calls.values())) +
+        " fs calls (" + ", ".join(name + "=" + str(n) for name, n in
+        calls.most_common(4)) + ")")
+      if category == "phase":
+        spans.sort(key = lambda s: s.start)
+      else:
+        spans.sort(key = lambda s: s.duration, reverse = True)
+        spans = spans[:top]
+      for s in spans:
+        lines.append("  %9.4f  %5d  %s" % (s.duration, sum(s.calls.values()),
+          s.name))
+    return lines
+
+  def trace(self, filename):
+    """Writes the spans in the Chrome trace event format.
+
+    The file can be opened with chrome://tracing or https://ui.perfetto.dev
+    """
+    events = []
+    for s in self.spans:
+      fields = dict(s.fields)
+      fields.update(s.calls)
+      events.append({"name": s.name, "cat": s.category, "ph": "X",
+        "ts": (s.start - self.origin) * 1e6, "dur": s.duration * 1e6,
+        "pid": os.getpid(), "tid": s.thread, "args": fields})
+    with open(filename, "w") as stream:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, stream)
+
+class Context:
+  """The options, output, profiler and action hooks of a run.
+
+  Everything that depends on how the program was run gets one, so runs in
+  the same process, like library calls from several threads or roots
+  installed by the same worker, don't share anything. When used in a with
+  statement, the output is flushed at the end.
+  """
+
+  def __init__(self, args, output = None, profiler = None, hooks = ()):
+    """
+    @param args: The options, as returned by parseArgs().
+    @param output: Where messages go. If None, nothing is printed.
+    @param profiler: The Profiler of the run. If None, nothing is profiled.
+    @param hooks: Functions called after every action, see addActionHook().
+    """
+    self.args = args
+    self.profiler = profiler if profiler is not None else Profiler()
+    self.output = output if output is not None else Output(None)
+    self.action_hooks = list(hooks)
+
+  @staticmethod
+  def fromOptions(log_format = None, hooks = (), **options):
+    """Returns the Context of a library call.
+
+    options are named like the command line options (non_interactive =
+    False, jobs = 4...), and the rest have the defaults of the command line.
+    Library calls are non-interactive unless told otherwise.
+
+    @param log_format: "text" or "json" to print like the command line does,
+      None to print nothing.
+
+    @raise TypeError: If one of the options doesn't exist.
+    """
+    args = parseArgs([])
+    args.non_interactive = True
+    for key, value in options.items():
+      if not hasattr(args, key):
+        raise TypeError("unknown option: " + key)
+      setattr(args, key, value)
+    profiler = Profiler()
+    return Context(args, Output(log_format, profiler = profiler), profiler,
+      hooks)
+
+  def derive(self, **options):
+    """Returns a Context with a copy of the options, updated with options.
+
+    The output, profiler and action hooks are shared.
+    """
+    args = argparse.Namespace(**vars(self.args))
+    for key, value in options.items():
+      setattr(args, key, value)
+    return Context(args, self.output, self.profiler, self.action_hooks)
+
+  def addActionHook(self, hook):
+    """Calls hook(action, metrics) after every action of a plan is applied.
+
+    action is the planned action (a dict, see Plan) and metrics is a dict
+    with its "status", "duration" and, when profiling, the filesystem "calls"
+    it made. Hooks are called in plan order from the main thread, and
+    anything they add to metrics is included in the log record of the
+    action.
+    """
+    self.action_hooks.append(hook)
+
+  def message(self, text, end = "\n", error = False):
+    self.output.message(text, end = end, error = error)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.output.flush()
+
+def parseArgs(argv):
+  """Parses the command line arguments of the program."""
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-d", "--dry-run", default=False, action="store_true",
+    help = "run the script without making any changes to the filesystem.")
+  parser.add_argument("--non-interactive", default=False, action="store_true",
+    help = "don't prompt the user for any information.")
+  parser.add_argument("-m", "--modules", nargs='+', default = [],
+    help = "only install the modules listed after this option.")
+  parser.add_argument("-e", "--exclude-modules", nargs='+', default = [],
+    help = "exclude the list of modules listed after this option.")
+  parser.add_argument("-f", "--flavors", nargs='+', default = [],
+    help = "use the flavors listed after this option. Flavors allow you to " +
+      "filter the modules and files installed when this script runs. See the " +
+      "website above for more info.")
+  parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+    help = "install up to N links, and compare up to N files with their " +
+      "backups, at the same time. Useful on slow filesystems like network " +
+      "home directories.")
+  parser.add_argument("--keep-backups", type=int, default=None, metavar="N",
+    help = "only keep the N most recent backups of each file, older ones " +
+      "are removed when a new backup is created.")
+  parser.add_argument("--state-dir", default="~/.metaconfig", metavar="DIR",
+    help = "where to keep the information saved between runs. Defaults " +
+      "to ~/.metaconfig")
+  parser.add_argument("--no-hash-cache", default=False, action="store_true",
+    help = "compare files with their backups byte by byte instead of " +
+      "using the digests saved in the state directory.")
+  parser.add_argument("-i", "--incremental", default=False,
+    action="store_true",
+    help = "skip the modules that didn't change since the last run, as " +
+      "long as the links they installed are still in place.")
+  parser.add_argument("--backup-store", default=False, action="store_true",
+    help = "keep backups in the state directory, stored once per content, " +
+      "instead of as .bakN next to the original.")
+  parser.add_argument("--restore", nargs='+', default = [], metavar="PATH",
+    help = "put the most recent backup of every PATH back in place of the " +
+      "symlink, and exit.")
+  parser.add_argument("--answers", default=None, metavar="FILE",
+    help = "answer the questions about modules, locations, links, " +
+      "directories and backups with the YAML file FILE. See the README for " +
+      "the format.")
+  parser.add_argument("--log-format", choices=["text", "json"],
+    default="text",
+    help = "with json, print one JSON record per module and action to " +
+      "stdout. Messages and prompts are sent to stderr instead.")
+  parser.add_argument("--typewriter", default=False, action="store_true",
+    help = "print messages one character at a time, for dramatic effect.")
+  parser.add_argument("--profile", default=False, action="store_true",
+    help = "measure the time and filesystem calls of every phase, module " +
+      "and link, and print the slowest ones at the end.")
+  parser.add_argument("--profile-top", type=int, default=10, metavar="N",
+    help = "number of modules, links and actions in the profile report.")
+  parser.add_argument("--profile-trace", default=None, metavar="FILE",
+    help = "save the profile to FILE in the Chrome trace format. Implies " +
+      "--profile.")
+  parser.add_argument("--atomic", default=False, action="store_true",
+    help = "if any action fails, undo every change made by this run.")
+  parser.add_argument("--rollback", default=False, action="store_true",
+    help = "undo every change made by the last run, using the journal in " +
+      "the state directory, and exit.")
+  parser.add_argument("--verify", default=False, action="store_true",
+    help = "check that the links installed by the last run are still in " +
+      "place, and exit without changing anything. Exits with 1 if any " +
+      "link is missing, wrong, broken or shadowed.")
+  parser.add_argument("--watch", default=False, action="store_true",
+    help = "after installing, keep running and install the modules again " +
+      "as soon as their files or metaconfig.yaml change. Implies " +
+      "--non-interactive and --incremental after the first run.")
+  parser.add_argument("--watch-interval", type=float, default=1.0,
+    metavar="SECONDS",
+    help = "how often to check for changes with --watch when inotify is " +
+      "not available. Defaults to 1 second.")
+  parser.add_argument("--roots", nargs='+', default = [], metavar="ROOT",
+    help = "install into every ROOT (a container or a chroot) instead of " +
+      "this computer. Paths are mapped into the root, and links point to " +
+      "this directory.")
+  parser.add_argument("--hosts", default=None, metavar="FILE",
+    help = "install into the roots listed in the YAML manifest FILE, each " +
+      "one with its own flavors, $HOME, environment and repository path. " +
+      "See the README for the format.")
+  parser.add_argument("--root-jobs", type=int, default=os.cpu_count() or 1,
+    metavar="N",
+    help = "install into up to N roots at the same time. Defaults to the " +
+      "number of CPUs.")
+  parser.add_argument("--save-plan", default=None, metavar="FILE",
+    help = "write the computed plan to FILE as JSON so it can be replayed " +
+      "later with --apply-plan.")
+  parser.add_argument("--apply-plan", default=None, metavar="FILE",
+    help = "don't look at the modules, apply the plan saved in FILE instead.")
+
+  args = parser.parse_args(argv)
+  if args.jobs < 1:
+    parser.error("--jobs must be at least 1.")
+  if args.keep_backups is not None and args.keep_backups < 1:
+    parser.error("--keep-backups must be at least 1.")
+  if args.root_jobs < 1:
+    parser.error("--root-jobs must be at least 1.")
+  if (args.roots or args.hosts) and (args.save_plan or args.apply_plan):
+    parser.error("--roots and --hosts can't be used with saved plans.")
+  if args.verify and (args.apply_plan or args.roots or args.hosts or
+      args.watch):
+    parser.error("--verify can't be used with --apply-plan, --roots, " +
+      "--hosts or --watch.")
+  if args.watch and (args.apply_plan or args.roots or args.hosts):
+    parser.error("--watch can't be used with --apply-plan, --roots or " +
+      "--hosts.")
+  if args.watch_interval <= 0:
+    parser.error("--watch-interval must be positive.")
+  return args
+
 def main(argv):
-  global args
-  print("""
+  args = parseArgs(argv)
+  profiler = Profiler(args.profile or args.profile_trace is not None)
+  output = Output(args.log_format,
+    typewriter = args.typewriter and not args.non_interactive,
+    profiler = profiler)
+  context = Context(args, output, profiler)
+  profiler.start()
+  try:
+    return run(context)
+  finally:
+    profiler.stop()
+    if profiler.enabled:
+      for line in profiler.report(args.profile_top):
+        context.message(line)
+    if args.profile_trace is not None:
+      profiler.trace(expandPath(args.profile_trace))
+      context.message("Trace saved to: " + args.profile_trace)
+    output.flush()
+
+def run(context):
+  """Runs the program with the options of context."""
+  args = context.args
+  context.message("""
     --- META CONFIG ---""")
 
   # Get the path of this file
   meta_dir = expandPath(os.path.dirname(os.path.realpath(__file__)))
 
-  print("""
+  context.message("""
     This script will backup and then create symlinks for some of the files on
     this computer according to the module (directory) configuration in:
     """ + meta_dir + """
@@ -77,179 +547,1987 @@ def main(argv):
     location is detected, no action will be taken for that file or directory.
     """)
 
-  parser = argparse.ArgumentParser()
-  parser.add_argument("-d", "--dry-run", default=False, action="store_true",
-    help = "run the script without making any changes to the filesystem.")
-  parser.add_argument("--non-interactive", default=False, action="store_true",
-    help = "don't prompt the user for any information.")
-  parser.add_argument("-m", "--modules", nargs='+', default = [],
-    help = "only install the modules listed after this option.")
-  parser.add_argument("-e", "--exclude-modules", nargs='+', default = [],
-    help = "exclude the list of modules listed after this option.")
-  parser.add_argument("-f", "--flavors", nargs='+', default = [],
-    help = "use the flavors listed after this option. Flavors allow you to " +
-      "filter the modules and files installed when this script runs. See the " +
-      "website above for more info.")
+  if args.dry_run:
+    context.message("DRY RUN. No changes will be made to the filesystem.",
+      error=True)
+  else:
+    context.message("Please review filenames carefully.", error=True)
+
+  state_dir = expandPath(args.state_dir)
+  hashes, store, state = openState(context, state_dir)
+  configs = ConfigCache(os.path.join(state_dir, "configs.json")).load()
+
+  # Backups may be in the store even if this run doesn't use it.
+  if store is None and (args.restore or args.rollback):
+    store = BackupStore(os.path.join(state_dir, "store"),
+      hashes or HashCache()).load()
+
+  if args.restore:
+    return 1 if restoreBackups(context, args.restore, store, state) else 0
+
+  if args.verify:
+    return verifyLinks(context, meta_dir, state, configs)
+
+  if args.rollback:
+    failed = rollback(context, os.path.join(state_dir, "journal.jsonl"),
+      store, state)
+    try:
+      state.save()
+    except OSError:
+      context.message("Warning: Could not save " + state.filename, error = True)
+    return 1 if failed else 0
+
+  if args.roots or args.hosts:
+    try:
+      targets = loadTargets(args, meta_dir)
+      return installRoots(context, targets, meta_dir, configs)
+    except ConfigError as e:
+      for error in e.errors:
+        context.message("Error: " + error, error = True)
+      context.message("Please fix the errors above. No changes were made.",
+        error = True)
+      return 1
+
+  answers = None
+  if args.apply_plan:
+    try:
+      plan = loadPlan(args.apply_plan)
+    except (OSError, ValueError) as e:
+      context.message("Error: Could not load plan " + args.apply_plan + ": " +
+        str(e), error = True)
+      return 1
+  else:
+    try:
+      if args.answers:
+        try:
+          answers = Answers.load(args.answers, args.flavors)
+        except OSError as e:
+          context.message("Error: Could not read " + args.answers + ": " +
+            e.strerror, error = True)
+          return 1
+      with context.profiler.span("plan", "phase"):
+        plan = planModules(context, meta_dir, hashes, store, state, configs,
+          answers = answers)
+    except ConfigError as e:
+      for error in e.errors:
+        context.message("Error: " + error, error = True)
+      context.message("Please fix the errors above. No changes were made.",
+        error = True)
+      return 1
+
+  if args.save_plan:
+    savePlan(plan, args.save_plan)
+    context.message("\nPlan saved to: " + args.save_plan)
+
+  results = installPlan(context, plan, state, store, [hashes, configs])
+  if args.watch:
+    return watchModules(context, meta_dir, hashes, store, state, configs,
+      answers)
+  failed = sum(1 for result in results or [] if result != "ok")
+  if failed:
+    context.message("\n" + str(failed) + " of " + str(len(results)) +
+      " actions failed.", error = True)
+  context.message("\n    ------ Done ------\n")
+  return 1 if failed else 0
+
+def openState(context, state_dir):
+  """Loads what is kept between runs in state_dir.
+
+  @return: (hashes, store, state), hashes and store are None if they are not
+    used in this run.
+  """
+  hashes = None
+  if not context.args.no_hash_cache:
+    hashes = HashCache(os.path.join(state_dir, "hashes.json")).load()
+  store = None
+  if context.args.backup_store:
+    store = BackupStore(os.path.join(state_dir, "store"),
+      hashes or HashCache(), context.args.keep_backups).load()
+  state = State(os.path.join(state_dir, "state.json")).load()
+  return hashes, store, state
+
+def installPlan(context, plan, state, store = None, saved = ()):
+  """Applies plan and saves the state, or just prints it with --dry-run.
+
+  @param saved: Other caches to save after applying the plan. None entries
+    are ignored.
+
+  @return: The results of applyPlan(), or None with --dry-run.
+  """
+  if context.args.dry_run:
+    printPlan(context, plan)
+    return None
+  # Runs that change nothing keep the journal of the last run that did.
+  journal = Journal()
+  if any(action["action"] in [ACTION_LINK, ACTION_BACKUP_LINK, ACTION_MKDIR]
+      for action in plan.actions):
+    journal = Journal(os.path.join(os.path.dirname(state.filename),
+      "journal.jsonl")).start()
+  try:
+    with context.profiler.span("apply", "phase"):
+      results = applyPlan(context, plan, context.args.jobs, store, journal)
+  finally:
+    journal.close()
+  if store is not None:
+    try:
+      store.finish()
+    except OSError:
+      context.message("Warning: Could not clean up " + store.directory,
+        error = True)
+  if context.args.atomic and any(result != "ok" for result in results):
+    context.message("\nSome actions failed. Rolling back the whole run.",
+      error = True)
+    if journal.filename is not None:
+      rollback(context, journal.filename, store)
+    return ["error"] * len(results)
+  with context.profiler.span("save", "phase"):
+    state.update(plan, results)
+    for cache in [state] + list(saved):
+      if cache is None:
+        continue
+      try:
+        cache.save()
+      except OSError:
+        context.message("Warning: Could not save " + cache.filename,
+          error = True)
+  return results
+
+def plan(repo, flavors = (), modules = (), answers = None, log_format = None,
+    **options):
+  """Computes the plan to install the modules of a repository.
+
+  Nothing is changed but the caches in the state directory. The plan can be
+  applied with apply(), or saved with savePlan().
+
+  @param repo: The metaconfig directory.
+  @param flavors: The flavors of this run.
+  @param modules: Only plan these modules, if not empty.
+  @param answers: Name of an answers file, if any.
+  @param options: Other command line options, see Context.fromOptions().
+
+  @return: A Plan.
+  @raise ConfigError: If any of the modules or the answers are not valid.
+  @raise OSError: If the answers file can't be read.
+  """
+  with Context.fromOptions(log_format, flavors = list(flavors),
+      modules = list(modules), **options) as context:
+    meta_dir = os.path.abspath(expandPath(repo))
+    state_dir = expandPath(context.args.state_dir)
+    hashes, store, state = openState(context, state_dir)
+    configs = ConfigCache(os.path.join(state_dir, "configs.json")).load()
+    if answers is not None:
+      answers = Answers.load(answers, context.args.flavors)
+    result = planModules(context, meta_dir, hashes, store, state, configs,
+      answers = answers)
+    try:
+      configs.save()
+    except OSError:
+      context.message("Warning: Could not save " + configs.filename,
+        error = True)
+    return result
+
+def apply(plan, log_format = None, hooks = (), **options):
+  """Applies a plan returned by plan() or loadPlan() and saves the state.
+
+  @param hooks: Functions called after every action, see
+    Context.addActionHook().
+  @param options: Other command line options, like jobs, atomic or
+    state_dir, see Context.fromOptions().
+
+  @return: The result of every action, "ok" or "error", or None with
+    dry_run.
+  """
+  with Context.fromOptions(log_format, hooks, **options) as context:
+    hashes, store, state = openState(context,
+      expandPath(context.args.state_dir))
+    if plan.store is not None:
+      store = plan.store
+    if plan.hashes is not None:
+      hashes = plan.hashes
+    return installPlan(context, plan, state, store, [hashes])
+
+def verify(repo, flavors = (), modules = (), log_format = None, **options):
+  """Checks the links installed in a repository, without changing anything.
+
+  The links recorded in the state of the last run are checked, or the ones
+  in the plan if there are none, like --verify does.
+
+  @param repo: The metaconfig directory.
+  @param flavors: The flavors used to plan, if nothing was recorded.
+  @param modules: Only check these modules, if not empty.
+  @param options: Other command line options, see Context.fromOptions().
+
+  @return: A list of (module, path, target, strategy, status) tuples where
+    status is one of the LINK_* constants or "error: " and a message.
+  @raise ConfigError: If the plan has to be computed and a module is not
+    valid.
+  """
+  with Context.fromOptions(log_format, flavors = list(flavors),
+      modules = list(modules), **options) as context:
+    state_dir = expandPath(context.args.state_dir)
+    state = State(os.path.join(state_dir, "state.json")).load()
+    configs = ConfigCache(os.path.join(state_dir, "configs.json")).load()
+    links = findLinks(context, os.path.abspath(expandPath(repo)), state,
+      configs)
+    return [link + (status,) for link, status in zip(links,
+      checkLinks(context, links))]
+
+def watchModules(context, meta_dir, hashes, store, state, configs,
+    answers = None):
+  """Installs the modules again every time they change, until interrupted.
+
+  Only the modules whose directory or metaconfig.yaml changed are planned,
+  non-interactively and incrementally, so only their new or broken links
+  are touched.
+
+  @return: The exit code.
+  """
+  context = context.derive(non_interactive = True, incremental = True)
+  args = context.args
+  discovered = discoverModules(meta_dir, args.modules, args.exclude_modules)
+  names = [name for (name, _, _, _) in discovered]
+  try:
+    watcher = InotifyWatcher(meta_dir, names)
+  except OSError:
+    watcher = PollingWatcher(meta_dir, discovered, args.watch_interval,
+      lambda: discoverModules(meta_dir, args.modules, args.exclude_modules))
+  context.message("\nWatching " + meta_dir + " for changes (" +
+    type(watcher).__name__ + "). Press Ctrl+C to stop.")
+  context.output.flush()
+
+  try:
+    while True:
+      changed = watcher.wait()
+      if changed is None:
+        # We lost track of what changed, so everything is planned again.
+        selected = args.modules
+      else:
+        selected = changedModules(changed, args.exclude_modules)
+        if args.modules:
+          selected = [name for name in selected if name in args.modules]
+        if not selected:
+          continue
+      discovered = discoverModules(meta_dir, selected, args.exclude_modules)
+      context.message("\n--- Changed: " +
+        (", ".join(selected) or "everything") + " ---")
+      try:
+        with context.profiler.span("plan", "phase"):
+          modules = loadModules(discovered, args.flavors, configs)
+          plan = planModules(context, meta_dir, hashes, store, state, configs,
+            modules = modules, answers = answers)
+      except ConfigError as e:
+        for error in e.errors:
+          context.message("Error: " + error, error = True)
+        context.message("Waiting for the errors above to be fixed.",
+          error = True)
+        context.output.flush()
+        continue
+      installPlan(context, plan, state, store, [hashes, configs])
+      context.output.flush()
+  except KeyboardInterrupt:
+    context.message("\nStopped watching.")
+  finally:
+    watcher.close()
+  return 0
+
+def changedModules(paths, exclude_modules = ()):
+  """Returns the sorted names of the modules affected by changed paths.
+
+  A plan only depends on the entries directly inside a module directory and
+  on its metaconfig.yaml, so a changed entry affects the directory that
+  contains it. Top level entries may be a new or removed module.
+
+  @param paths: The changed entries, relative to the metaconfig directory.
+  @param exclude_modules: Modules that are never returned.
+  """
+  modules = set()
+  for path in paths:
+    parent = os.path.dirname(path)
+    modules.add(parent or path)
+  return sorted(name for name in modules
+    if not name.split(os.sep)[0].startswith(".") and
+      name not in exclude_modules)
+
+class InotifyWatcher:
+  """Reports changes in the metaconfig directory using inotify.
+
+  Every directory that discovery walks is watched. New directories are
+  watched as soon as they are created.
+  """
+
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_Q_OVERFLOW = 0x4000
+  IN_IGNORED = 0x8000
+  IN_ISDIR = 0x40000000
+  MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+  EVENT = struct.Struct("iIII")
+  # Changes are collected until there are none for this long, so a burst of
+  # changes, like a git pull, is handled at once.
+  SETTLE = 0.2
+
+  def __init__(self, meta_dir, names):
+    """
+    @raise OSError: If inotify is not available.
+    """
+    import ctypes, ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    if not hasattr(libc, "inotify_init1"):
+      raise OSError("inotify is not available")
+    self.libc = libc
+    self.meta_dir = meta_dir
+    self.fd = libc.inotify_init1(os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    # Maps watch descriptors to directory names.
+    self.names = {}
+    for name in [""] + names:
+      self.add(name)
+
+  def add(self, name):
+    wd = self.libc.inotify_add_watch(self.fd,
+      os.fsencode(os.path.join(self.meta_dir, name)), self.MASK)
+    if wd >= 0:
+      self.names[wd] = name
+
+  def addTree(self, name):
+    """Watches a new directory and everything in it."""
+    self.add(name)
+    for dir_path, dir_names, _ in os.walk(os.path.join(self.meta_dir, name)):
+      dir_names[:] = [d for d in dir_names if not d.startswith(".")]
+      for d in dir_names:
+        self.add(os.path.relpath(os.path.join(dir_path, d), self.meta_dir))
+
+  def wait(self):
+    """Blocks until something changes.
+
+    @return: The set of changed paths, relative to the metaconfig directory,
+      or None if some changes were lost.
+    """
+    changed = set()
+    ready, _, _ = select.select([self.fd], [], [])
+    while ready:
+      data = os.read(self.fd, 65536)
+      offset = 0
+      while offset < len(data):
+        wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+        offset += self.EVENT.size
+        entry = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+        offset += length
+        if mask & self.IN_Q_OVERFLOW:
+          changed = None
+        if mask & self.IN_IGNORED:
+          self.names.pop(wd, None)
+        if wd not in self.names or not entry:
+          continue
+        parent = self.names[wd]
+        path = os.path.join(parent, entry) if parent else entry
+        if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO) \
+            and not entry.startswith("."):
+          self.addTree(path)
+        if changed is not None:
+          changed.add(path)
+      ready, _, _ = select.select([self.fd], [], [], self.SETTLE)
+    return changed
+
+  def close(self):
+    os.close(self.fd)
+
+class PollingWatcher:
+  """Reports changes in the metaconfig directory by polling.
+
+  Only the directories found by discovery and their metaconfig.yaml files
+  are checked, with one stat() each. The tree is walked again only when one
+  of them changed.
+  """
+
+  CONFIG_NAMES = ["localmetaconfig.yaml", "metaconfig.yaml"]
+
+  def __init__(self, meta_dir, discovered, interval, discover):
+    """
+    @param discovered: The result of discoverModules().
+    @param interval: Seconds between checks.
+    @param discover: Called without arguments to discover the modules again.
+    """
+    self.meta_dir = meta_dir
+    self.interval = interval
+    self.discover = discover
+    self.entries = {}
+    self.snapshot = self.take(discovered)
+
+  def take(self, discovered):
+    """Remembers the entries of every directory and returns their stats."""
+    self.entries = {"": set(os.listdir(self.meta_dir))}
+    paths = {"": self.meta_dir}
+    for (name, path, dir_names, file_names) in discovered:
+      self.entries[name] = set(dir_names + file_names)
+      paths[name] = path
+    return self.stat(paths)
+
+  def stat(self, paths):
+    snapshot = {}
+    for name, path in paths.items():
+      signature = []
+      for config in [""] + self.CONFIG_NAMES:
+        if config and config not in self.entries.get(name, ()):
+          continue
+        try:
+          signature.append(os.stat(os.path.join(path, config)).st_mtime_ns)
+        except OSError:
+          signature.append(None)
+      snapshot[name] = (path, signature)
+    return snapshot
+
+  def wait(self):
+    """Blocks until something changes. See InotifyWatcher.wait()."""
+    while True:
+      time.sleep(self.interval)
+      current = self.stat({name: path
+        for name, (path, _) in self.snapshot.items()})
+      if current == self.snapshot:
+        continue
+      old_entries = self.entries
+      changed = set()
+      for name, (_, signature) in current.items():
+        if signature[1:] != self.snapshot[name][1][1:]:
+          changed.add(os.path.join(name, "metaconfig.yaml"))
+      self.snapshot = self.take(self.discover())
+      for name in set(old_entries) | set(self.entries):
+        for entry in old_entries.get(name, set()) ^ \
+            self.entries.get(name, set()):
+          changed.add(os.path.join(name, entry) if name else entry)
+      if changed:
+        return changed
+
+  def close(self):
+    pass
+
+# Status of an installed link, see checkLink().
+LINK_CORRECT = "correct"
+LINK_MISSING = "missing"
+LINK_WRONG = "wrong"
+LINK_BROKEN = "broken"
+LINK_SHADOWED = "shadowed"
+
+def verifyLinks(context, meta_dir, state, configs):
+  """Checks that the links are in place, without changing anything.
+
+  @return: The exit code. 0 if every link is correct, 1 if any of them is
+    not, 2 if there is nothing to check.
+  """
+  try:
+    links = findLinks(context, meta_dir, state, configs)
+  except ConfigError as e:
+    for error in e.errors:
+      context.message("Error: " + error, error = True)
+    return 2
+  if not links:
+    context.message("Nothing to verify.", error = True)
+    return 2
+
+  context.message("\n--- Verify ---")
+  counts = collections.Counter()
+  for (module_name, path, target, strategy), status in zip(links,
+      checkLinks(context, links)):
+    counts[status] += 1
+    if status != LINK_CORRECT:
+      context.message("  %-8s %s -> %s [%s]" % (status, path, target,
+        module_name), error = True)
+  context.message("Verified " + str(len(links)) + " links: " +
+    ", ".join(str(n) + " " + status for status, n in sorted(counts.items())))
+  return 0 if counts[LINK_CORRECT] == len(links) else 1
+
+def findLinks(context, meta_dir, state, configs):
+  """Returns the links that should be in place.
+
+  These are the links recorded in the state of the last run. If there are
+  none, the plan is computed non-interactively and its links are returned
+  instead.
+
+  @return: A list of (module, path, target, strategy) tuples.
+  @raise ConfigError: If the plan is computed and a module is not valid.
+  """
+  links = state.links(context.args.modules, context.args.exclude_modules)
+  if links:
+    return links
+  context.message("No links recorded in " + state.filename + ". Computing " +
+    "the plan instead.")
+  plan = planModules(context.derive(non_interactive = True), meta_dir,
+    configs = configs)
+  return [(action["module"], action["path"], action["target"],
+    action.get("strategy", STRATEGY_SYMLINK)) for action in plan.actions
+    if action["action"] in [ACTION_NOOP, ACTION_LINK, ACTION_BACKUP_LINK]]
+
+def checkLinks(context, links):
+  """Returns the status of every link, see checkLink().
+
+  @param links: (module, path, target, strategy) tuples, see findLinks().
+  @return: A list with one of the LINK_* constants, or "error: " and a
+    message, for every link.
+  """
+  statuses = []
+  for module_name, path, target, strategy in links:
+    try:
+      status = checkLink(path, target, strategy)
+    except OSError as e:
+      status = "error: " + e.strerror
+    statuses.append(status)
+    context.output.record(action = "verify", module = module_name, path = path,
+      target = target, strategy = strategy, status = status)
+  return statuses
+
+def checkLink(path, target, strategy = None):
+  """Returns the status of the symlink at path, which should point to target.
+
+  Correct links only need a readlink() and a stat(). Hard links and copies
+  are correct if they are still the same as target, and wrong otherwise.
+
+  @param strategy: How it was installed, see STRATEGIES.
+  @return: One of the LINK_* constants.
+  @raise OSError: If path can't be checked.
+  """
+  if strategy not in [None, STRATEGY_SYMLINK]:
+    if not os.path.lexists(path):
+      return LINK_MISSING
+    if isInstalled(path, target, strategy):
+      return LINK_CORRECT
+    return LINK_WRONG
+  try:
+    current = os.readlink(path)
+  except OSError as e:
+    if e.errno in [errno.ENOENT, errno.ENOTDIR]:
+      return LINK_MISSING
+    if e.errno == errno.EINVAL:
+      # There is something else in the way.
+      return LINK_SHADOWED
+    raise
+  if not os.path.exists(path):
+    return LINK_BROKEN
+  if current == target:
+    return LINK_CORRECT
+  # It may still be an equivalent link, like a relative one.
+  try:
+    if os.path.samefile(path, target):
+      return LINK_CORRECT
+  except OSError:
+    pass
+  return LINK_WRONG
+
+# Fields allowed in the entries of a --hosts manifest and their types.
+TARGET_FIELDS = {"root": str, "name": str, "flavors": list, "home": str,
+  "env": dict, "repo": str, "answers": str}
+
+class Target:
+  """A root directory to install into, like a container or a chroot.
+
+  Paths are computed as seen from inside the root, with its own $HOME and
+  environment, and then mapped into it.
+  """
+
+  __slots__ = ["name", "root", "flavors", "home", "env", "repo", "answers"]
+
+  def __init__(self, root, name = None, flavors = (), home = None, env = None,
+      repo = None, answers = None):
+    self.root = os.path.abspath(expandPath(root))
+    self.name = name or os.path.basename(self.root.rstrip(os.sep)) or os.sep
+    self.flavors = list(flavors)
+    self.home = home or os.path.expanduser("~")
+    self.env = dict(env or {})
+    # Where the metaconfig directory is seen from inside the root. Links
+    # point there.
+    self.repo = repo
+    self.answers = answers
+
+  def path(self, path):
+    """Maps an absolute path inside the root to the same path outside."""
+    return os.path.join(self.root,
+      os.path.relpath(os.path.abspath(path), os.sep))
+
+def loadTargets(args, meta_dir):
+  """Returns the Targets given with --roots and in the --hosts manifest.
+
+  A manifest has an optional "defaults" entry and a list of "roots", both
+  with the fields in TARGET_FIELDS:
+
+    defaults:
+      flavors: [linux]
+      repo: /opt/metaconfig
+    roots:
+      - root: /srv/sandbox1
+      - root: /srv/sandbox2
+        home: /home/builder
+        env: {XDG_CONFIG_HOME: /home/builder/.config}
+
+  @raise ConfigError: If the manifest can't be read or is not valid.
+  """
+  defaults = {"flavors": args.flavors, "repo": meta_dir,
+    "answers": args.answers}
+  entries = [dict(defaults, root = root) for root in args.roots]
+  if args.hosts:
+    try:
+      with open(expandPath(args.hosts), 'rb') as stream:
+        data = loadYaml(stream, args.hosts)
+    except OSError as e:
+      raise ConfigError([args.hosts + ": " + e.strerror])
+    errors = checkFields(data, {"defaults": dict, "roots": object},
+      args.hosts)
+    if not errors and not isinstance(data.get("roots") or [], list):
+      errors.append(args.hosts + ": 'roots' should be a list")
+    if errors:
+      raise ConfigError(errors)
+    errors = checkFields(data.get("defaults") or {}, TARGET_FIELDS,
+      args.hosts + ": defaults")
+    if not errors:
+      errors = checkEnv((data.get("defaults") or {}).get("env") or {},
+        args.hosts + ": defaults")
+    if errors:
+      raise ConfigError(errors)
+    defaults.update(data.get("defaults") or {})
+    for i, entry in enumerate(data.get("roots") or []):
+      where = args.hosts + ": roots: " + str(i + 1)
+      entry_errors = checkFields(entry, TARGET_FIELDS, where)
+      if not entry_errors and not entry.get("root"):
+        entry_errors.append(where + ": 'root' is mandatory")
+      if not entry_errors:
+        entry_errors = checkEnv(entry.get("env") or {}, where)
+      errors += entry_errors
+      if not entry_errors:
+        entries.append(dict(defaults, **entry))
+    if errors:
+      raise ConfigError(errors)
+  return [Target(**entry) for entry in entries]
+
+def installRoots(context, targets, meta_dir, configs):
+  """Installs the modules into every target, in parallel.
+
+  Modules are discovered and loaded once. Every target is then planned and
+  applied in a worker process, non-interactively.
+
+  @return: The exit code, 1 if any target failed.
+  """
+  with context.profiler.span("discovery", "phase"):
+    discovered = discoverModules(meta_dir, context.args.modules,
+      context.args.exclude_modules)
+  # Fingerprints depend on the flavors, so modules are loaded once per set
+  # of flavors. The files are only parsed the first time.
+  modules = {}
+  with context.profiler.span("load", "phase"):
+    for target in targets:
+      key = tuple(target.flavors)
+      if key not in modules:
+        modules[key] = loadModules(discovered, target.flavors, configs)
+  try:
+    configs.save()
+  except OSError:
+    context.message("Warning: Could not save " + configs.filename,
+      error = True)
+
+  context.message("Installing " + str(len(discovered)) + " directories " +
+    "into " + str(len(targets)) + " roots.")
+  failed = 0
+  workers = min(context.args.root_jobs, len(targets)) or 1
+  import concurrent.futures
+  with context.profiler.span("roots", "phase"), \
+      concurrent.futures.ProcessPoolExecutor(workers) as pool:
+    futures = [pool.submit(installRoot, target, meta_dir,
+      modules[tuple(target.flavors)], context.args) for target in targets]
+    for target, future in zip(targets, futures):
+      context.message("\n=== Root: " + target.name + " (" + target.root +
+        ") ===")
+      try:
+        status, stdout, stderr = future.result()
+      except Exception as e:
+        status, stdout, stderr = "error", "", ""
+        context.message("Error: " + type(e).__name__ + ": " + str(e),
+          error = True)
+      context.output.flush()
+      sys.stdout.write(stdout)
+      sys.stderr.write(stderr)
+      context.output.record(action = "root", root = target.root,
+        name = target.name, status = status)
+      if status != "ok":
+        failed += 1
+
+  context.message("\nInstalled into " + str(len(targets) - failed) + " of " +
+    str(len(targets)) + " roots.", error = failed > 0)
+  context.message("\n    ------ Done ------\n")
+  return 1 if failed else 0
+
+def installRoot(target, meta_dir, modules, run_args):
+  """Plans and applies modules in target. Runs in a worker process.
+
+  @return: (status, stdout, stderr) where status is "ok" or "error" and
+    stdout and stderr are the output of the run.
+  """
+  args = argparse.Namespace(**vars(run_args))
+  args.flavors = target.flavors
+  args.non_interactive = True
+  context = Context(args, Output(args.log_format))
+  # Workers are reused for other roots, so the environment is put back.
+  environ = dict(os.environ)
+  stdout, stderr = io.StringIO(), io.StringIO()
+  with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+    try:
+      os.environ.update(target.env)
+      os.environ["HOME"] = target.home
+      answers = None
+      if target.answers:
+        answers = Answers.load(target.answers, target.flavors, target.name)
+      hashes, store, state = openState(context, target.path(
+        expandPath(args.state_dir)))
+      plan = planModules(context, meta_dir, hashes, store, state,
+        modules = modules, answers = answers, target = target)
+      results = installPlan(context, plan, state, store, [hashes])
+    except (ConfigError, OSError) as e:
+      context.message("Error: " + str(e), error = True)
+      results = ["error"]
+    finally:
+      context.output.flush()
+      os.environ.clear()
+      os.environ.update(environ)
+  status = "ok"
+  if any(result != "ok" for result in results or []):
+    status = "error"
+  return status, stdout.getvalue(), stderr.getvalue()
+
+# Types of actions a plan can contain.
+ACTION_NOOP = "noop"
+ACTION_LINK = "link"
+ACTION_BACKUP_LINK = "backup+link"
+ACTION_MKDIR = "mkdir"
+ACTION_ERROR = "error"
+
+# Bump this whenever the format of saved plans changes.
+PLAN_VERSION = 3
+
+class Plan:
+  """An ordered list of actions computed before touching the filesystem.
+
+  Every action is a plain dict with at least an "action" (one of the ACTION_*
+  constants) and a "module" field, so plans can be saved as JSON and applied
+  later, possibly on a different computer.
+  """
+
+  def __init__(self, meta_dir, flavors = None):
+    self.meta_dir = meta_dir
+    self.flavors = list(flavors or [])
+    self.actions = []
+    # Maps the name of every module considered in this plan to the
+    # fingerprint of its inputs, see moduleFingerprint().
+    self.fingerprints = {}
+    # Directories that will be created by this plan. Used while planning so
+    # that we only ask once per directory.
+    self.created_dirs = set()
+    # Existing and planned backups.
+    self.backups = BackupIndex()
+    # Used to compare elements with their backups, if not None.
+    self.hashes = None
+    # Where backups go. If None, they are kept next to the original as .bakN
+    self.store = None
+    # Answers used instead of prompting the user.
+    self.answers = Answers()
+    # The Target this plan installs into, None for this computer.
+    self.target = None
+    # Remembers the paths looked up while planning.
+    self.resolver = Resolver()
+    # Decides which modules and links are installed with these flavors.
+    self.flavor_filter = FlavorFilter(self.flavors)
+    # Maps the name of a module to the modules it depends on, if any.
+    self.dependencies = {}
+
+  def add(self, action_type, module_name, **fields):
+    action = {"action": action_type, "module": module_name}
+    action.update(fields)
+    self.actions.append(action)
+    if action_type == ACTION_MKDIR:
+      self.created_dirs.add(os.path.abspath(fields["path"]))
+    return action
+
+  def checkConflicts(self):
+    """Turns links that would step on each other into errors.
+
+    Two links conflict if they install at the same path, or if one of them
+    would be installed inside the other one (a parent/child pair). The first
+    link wins, later ones are replaced by an ACTION_ERROR. This is what makes
+    it safe to install the links of a plan in any order.
+
+    @return: The number of conflicts found.
+    """
+    owners = {}
+    # Maps every parent directory of an accepted link to that link.
+    children = {}
+    conflicts = 0
+    for i, action in enumerate(self.actions):
+      if action["action"] not in [ACTION_NOOP, ACTION_LINK, ACTION_BACKUP_LINK]:
+        continue
+      path = os.path.normpath(action["path"])
+      parents = []
+      parent = os.path.dirname(path)
+      while parent != os.path.dirname(parent):
+        parents.append(parent)
+        parent = os.path.dirname(parent)
+      owner = owners.get(path) or children.get(path)
+      for parent in parents:
+        if owner is not None:
+          break
+        owner = owners.get(parent)
+      if owner is None:
+        owners[path] = action
+        for parent in parents:
+          children.setdefault(parent, action)
+        continue
+      conflicts += 1
+      self.actions[i] = {"action": ACTION_ERROR, "module": action["module"],
+        "path": action["path"], "target": action["target"],
+        "message": "Conflicting links: " + action["path"] + " and " +
+          owner["path"] + " (module " + owner["module"] + ") are the same " +
+          "path or one is inside the other."}
+    return conflicts
+
+  def prerequisites(self):
+    """Returns the set of modules every module depends on, directly or not.
+
+    @raise ValueError: If the dependencies have a cycle.
+    """
+    names = [action["module"] for action in self.actions]
+    for name, dependencies in self.dependencies.items():
+      names += [name] + dependencies
+    result = {}
+    for name in sortByDependencies(list(dict.fromkeys(names)),
+        self.dependencies):
+      result[name] = set()
+      for dependency in self.dependencies.get(name, []):
+        result[name] |= {dependency} | result[dependency]
+    return result
+
+  def toDict(self):
+    return {"version": PLAN_VERSION, "meta_dir": self.meta_dir,
+      "flavors": self.flavors, "fingerprints": self.fingerprints,
+      "dependencies": self.dependencies, "actions": self.actions}
+
+  # Fields every type of action needs.
+  REQUIRED_FIELDS = {
+    ACTION_NOOP: ["path", "target"],
+    ACTION_LINK: ["path", "target"],
+    ACTION_BACKUP_LINK: ["path", "target", "backup", "current_backup"],
+    ACTION_MKDIR: ["path"],
+    ACTION_ERROR: ["message"],
+  }
+
+  @staticmethod
+  def fromDict(data):
+    """Returns the Plan saved with toDict().
+
+    @raise ValueError: If data is not a valid plan.
+    """
+    if not isinstance(data, dict) or data.get("version") != PLAN_VERSION:
+      raise ValueError("unsupported plan version")
+    if not isinstance(data.get("meta_dir"), str):
+      raise ValueError("'meta_dir' is missing")
+    if not isinstance(data.get("actions"), list):
+      raise ValueError("'actions' is missing")
+    for key in ["fingerprints", "dependencies"]:
+      if not isinstance(data.get(key, {}), dict):
+        raise ValueError("'" + key + "' should be a dict")
+    for name, dependencies in data.get("dependencies", {}).items():
+      if not isinstance(dependencies, list):
+        raise ValueError("the dependencies of " + name + " should be a list")
+    plan = Plan(data["meta_dir"], data.get("flavors", []))
+    plan.fingerprints = data.get("fingerprints", {})
+    plan.dependencies = data.get("dependencies", {})
+    plan.prerequisites()
+    for i, action in enumerate(data["actions"]):
+      if not isinstance(action, dict):
+        raise ValueError("action " + str(i + 1) + " should be a dict")
+      fields = dict(action)
+      action_type = fields.pop("action", None)
+      if action_type not in Plan.REQUIRED_FIELDS:
+        raise ValueError("unknown action: " + str(action_type))
+      where = "action " + str(i + 1) + " (" + action_type + ")"
+      for key in Plan.REQUIRED_FIELDS[action_type]:
+        if key not in fields:
+          raise ValueError(where + " is missing '" + key + "'")
+        # Backups are None when there is nothing to back up or no exact
+        # backup yet.
+        if not isinstance(fields[key], str) and not (fields[key] is None and
+            key in ["backup", "current_backup"]):
+          raise ValueError(where + ": '" + key + "' should be a string")
+      plan.add(action_type, fields.pop("module", ""), **fields)
+    plan.checkConflicts()
+    return plan
+
+def savePlan(plan, filename):
+  with open(expandPath(filename), "w") as stream:
+    json.dump(plan.toDict(), stream, indent = 2)
+    stream.write("\n")
+
+def loadPlan(filename):
+  with open(expandPath(filename), "r") as stream:
+    return Plan.fromDict(json.load(stream))
+
+def discoverModules(meta_dir, modules = [], exclude_modules = []):
+  """Finds the directories in meta_dir that may contain a module.
+
+  Hidden directories, excluded modules and, if a list of modules is given,
+  directories that can't contain any of them are never entered, so large
+  trees like .git are not walked at all.
+
+  @param meta_dir: The metaconfig directory.
+  @param modules: Only these modules (and their parents) are returned, if
+    not empty.
+  @param exclude_modules: These modules and everything inside them are
+    skipped.
+
+  @return: A list of (module_name, path, dir_names, file_names) tuples, like
+    os.walk() would return them, sorted by name, parents first.
+  """
+  def wanted(name):
+    if name in exclude_modules:
+      return False
+    if not modules:
+      return True
+    prefix = name + os.sep
+    return name in modules or any(m.startswith(prefix) for m in modules)
+
+  found = []
+  pending = [("", meta_dir)]
+  while pending:
+    name, path = pending.pop()
+    try:
+      with os.scandir(path) as it:
+        entries = sorted(it, key = lambda entry: entry.name)
+    except OSError:
+      continue
+    dir_names, file_names, subdirs = [], [], []
+    for entry in entries:
+      try:
+        is_dir = entry.is_dir()
+      except OSError:
+        is_dir = False
+      (dir_names if is_dir else file_names).append(entry.name)
+      if is_dir and not entry.is_symlink() and not entry.name.startswith("."):
+        child = entry.name if not name else name + os.sep + entry.name
+        if wanted(child):
+          subdirs.append((child, entry.path))
+    if name and (not modules or name in modules):
+      found.append((name, path, dir_names, file_names))
+    pending.extend(reversed(subdirs))
+  return found
+
+def moduleFingerprint(module_name, config, names, flavors):
+  """Digest of everything the plan of a module depends on, but the answers.
+
+  planModule() adds the answers of the module, see Answers.digest(), and the
+  destinations as expanded in this run.
+
+  @param module_name: The name of the module.
+  @param config: The contents of its yaml file, None if there isn't one.
+  @param names: The names of the entries in the module directory.
+  @param flavors: The flavors used in this run.
+  """
+  h = hashlib.sha256(module_name.encode() + b"\0")
+  h.update(config if config is not None else b"\0")
+  for name in sorted(names):
+    h.update(b"\0" + os.fsencode(name))
+  h.update(b"\0" + json.dumps(sorted(flavors)).encode())
+  return h.hexdigest()
+
+class State:
+  """What the last successful run installed, saved between runs.
+
+  For every module it keeps the fingerprint of its inputs (see
+  moduleFingerprint()) and the links it installed.
+  """
+
+  VERSION = 1
+
+  def __init__(self, filename):
+    self.filename = filename
+    # Maps a module name to {"fingerprint": ..., "links": [[path, target]]}.
+    self.modules = {}
+
+  def load(self):
+    try:
+      with open(self.filename, "r") as stream:
+        data = json.load(stream)
+      if data.get("version") == self.VERSION:
+        self.modules = data["modules"]
+    except (OSError, ValueError, KeyError, AttributeError):
+      self.modules = {}
+    return self
+
+  def save(self):
+    os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+    with open(self.filename + ".tmp", "w") as stream:
+      json.dump({"version": self.VERSION, "modules": self.modules}, stream,
+        indent = 1)
+    os.replace(self.filename + ".tmp", self.filename)
+
+  def unchanged(self, module_name, fingerprint):
+    """Checks if a module and the links it installed are still the same."""
+    entry = self.modules.get(module_name)
+    if entry is None or entry["fingerprint"] != fingerprint:
+      return False
+    for link in entry["links"]:
+      if not isInstalled(*link):
+        return False
+    return True
+
+  def links(self, modules = (), exclude_modules = ()):
+    """Returns the (module_name, path, target, strategy) of every link.
+
+    @param modules: Only the links of these modules, if not empty.
+    @param exclude_modules: Not the links of these modules.
+    """
+    links = []
+    for module_name, entry in sorted(self.modules.items()):
+      if (modules and module_name not in modules) or \
+          module_name in exclude_modules:
+        continue
+      for link in entry["links"]:
+        path, target = link[:2]
+        strategy = link[2] if len(link) > 2 else STRATEGY_SYMLINK
+        links.append((module_name, path, target, strategy))
+    return links
+
+  def update(self, plan, results):
+    """Records the modules of an applied plan.
+
+    Links are saved as [path, target], followed by their strategy if it's
+    not a symlink.
+
+    Modules with a failed action are forgotten, so they are planned again on
+    the next run.
+
+    @param results: The results of applyPlan().
+    """
+    failed = set()
+    links = {}
+    for action, result in zip(plan.actions, results):
+      if result != "ok":
+        failed.add(action["module"])
+      elif action["action"] in [ACTION_NOOP, ACTION_LINK, ACTION_BACKUP_LINK]:
+        link = [action["path"], action["target"]]
+        if "strategy" in action:
+          link.append(action["strategy"])
+        links.setdefault(action["module"], []).append(link)
+    for module_name, fingerprint in plan.fingerprints.items():
+      if module_name in failed:
+        self.modules.pop(module_name, None)
+      else:
+        self.modules[module_name] = {"fingerprint": fingerprint,
+          "links": links.get(module_name, [])}
+
+class ConfigError(ValueError):
+  """Raised when one or more metaconfig.yaml files are not valid."""
+
+  def __init__(self, errors):
+    ValueError.__init__(self, "\n".join(errors))
+    self.errors = errors
+
+# Fields allowed in metaconfig.yaml files and their types.
+MODULE_FIELDS = {"location": str, "prompt_location": bool, "enabled": bool,
+  "infer_symlinks": bool, "exclude": list, "ignore": list, "flavors": list,
+  "symlinks": list, "strategy": str, "depends_on": list}
+# Fields allowed in symlink objects and their types.
+LINK_FIELDS = {"file": str, "target": str, "enabled": bool, "flavors": list,
+  "strategy": str}
+
+# Ways of installing a file. Everything but symlinks is a copy that has to be
+# installed again when the file in the module changes.
+STRATEGY_SYMLINK = "symlink"
+STRATEGY_HARDLINK = "hardlink"
+STRATEGY_COPY = "copy"
+STRATEGY_REFLINK = "reflink"
+STRATEGIES = [STRATEGY_SYMLINK, STRATEGY_HARDLINK, STRATEGY_COPY,
+  STRATEGY_REFLINK]
+
+def checkFields(data, fields, where):
+  """Returns a list of errors found checking data against fields."""
+  if not isinstance(data, dict):
+    return [where + ": expected a mapping, found " + type(data).__name__]
+  errors = []
+  for key, value in data.items():
+    if key not in fields:
+      errors.append(where + ": unknown field '" + str(key) + "'. Valid " +
+        "fields are: " + ", ".join(sorted(fields)))
+    elif value is not None and not isinstance(value, fields[key]):
+      errors.append(where + ": '" + key + "' should be a " +
+        fields[key].__name__ + ", found " + type(value).__name__)
+    elif fields[key] is list and key != "symlinks" and value is not None and \
+        not all(isinstance(item, str) for item in value):
+      errors.append(where + ": '" + key + "' should be a list of strings")
+  return errors
+
+def checkStrategy(data, where):
+  """Returns a list of errors if the strategy in data is not valid."""
+  strategy = data.get("strategy")
+  if isinstance(strategy, str) and strategy not in STRATEGIES:
+    return [where + ": unknown strategy '" + strategy + "'. Valid " +
+      "strategies are: " + ", ".join(STRATEGIES)]
+  return []
+
+def checkPatterns(patterns, where):
+  """Returns the errors of the regexes in patterns that don't compile."""
+  errors = []
+  for pattern in patterns:
+    if pattern.startswith(Matcher.REGEX_PREFIX):
+      try:
+        re.compile(pattern[len(Matcher.REGEX_PREFIX):])
+      except re.error as e:
+        errors.append(where + ": invalid regex '" + pattern + "': " + str(e))
+  return errors
+
+def checkEnv(env, where):
+  """Returns the errors of the environment variables that are not strings."""
+  return [where + ": env: '" + str(name) + "' should be a string, found " +
+    type(value).__name__ for name, value in env.items()
+    if not isinstance(name, str) or not isinstance(value, str)]
+
+def checkFlavors(flavors, where):
+  """Returns the errors of the flavor expressions that don't compile."""
+  errors = []
+  for text in flavors:
+    try:
+      FlavorExpression.get(text)
+    except ValueError as e:
+      errors.append(where + ": " + str(e))
+  return errors
+
+class Matcher:
+  """Matches names against a list of patterns with a single compiled regex.
+
+  Patterns are globs, like "*.vim", or regexes prefixed with "re:", like
+  "re:.*rc$". Either way, the whole name has to match.
+  """
+
+  REGEX_PREFIX = "re:"
+
+  # Matchers compiled so far, by their patterns. Most modules share them.
+  compiled = {}
+
+  def __init__(self, patterns):
+    parts = []
+    for pattern in patterns:
+      if pattern.startswith(self.REGEX_PREFIX):
+        parts.append("(?:" + pattern[len(self.REGEX_PREFIX):] + r")\Z")
+      else:
+        parts.append(fnmatch.translate(pattern))
+    self.regex = re.compile("|".join(parts)) if parts else None
+
+  @classmethod
+  def get(cls, patterns):
+    """Returns the Matcher for a list of patterns, compiling it only once."""
+    key = tuple(patterns)
+    matcher = cls.compiled.get(key)
+    if matcher is None:
+      matcher = cls.compiled[key] = cls(patterns)
+    return matcher
+
+  @classmethod
+  def isPattern(cls, text):
+    """Checks if text is a pattern rather than a plain name."""
+    return text.startswith(cls.REGEX_PREFIX) or any(c in text for c in "*?[")
+
+  def match(self, name):
+    return self.regex is not None and self.regex.match(name) is not None
+
+class FlavorExpression:
+  """A boolean expression of flavors, like "linux and (home or not work)".
+
+  Expressions are compiled once into nested functions that take the set of
+  active flavors and return a bool. A plain flavor name is the simplest
+  expression and is true if that flavor is active.
+  """
+
+  KEYWORDS = ["and", "or", "not"]
+  TOKEN = re.compile(r"\s*(?:([()])|([^\s()]+))")
+
+  # Expressions compiled so far, by their text.
+  compiled = {}
+
+  def __init__(self, text):
+    self.text = text
+    self.tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+      match = self.TOKEN.match(text, position)
+      self.tokens.append(match.group(1) or match.group(2))
+      position = match.end()
+    self.position = 0
+    self.evaluate = self.parseOr()
+    if self.position < len(self.tokens):
+      self.fail("unexpected '" + self.tokens[self.position] + "'")
+    del self.tokens
+
+  @classmethod
+  def get(cls, text):
+    """Returns the compiled expression for text, compiling it only once.
+
+    @raise ValueError: If text is not a valid expression.
+    """
+    expression = cls.compiled.get(text)
+    if expression is None:
+      expression = cls.compiled[text] = cls(text)
+    return expression
+
+  def fail(self, message):
+    raise ValueError("invalid flavor expression '" + self.text + "': " +
+      message)
+
+  def next(self):
+    if self.position >= len(self.tokens):
+      self.fail("unexpected end")
+    token = self.tokens[self.position]
+    self.position += 1
+    return token
+
+  def peek(self):
+    if self.position < len(self.tokens):
+      return self.tokens[self.position]
+    return None
+
+  def parseOr(self):
+    terms = [self.parseAnd()]
+    while self.peek() == "or":
+      self.next()
+      terms.append(self.parseAnd())
+    if len(terms) == 1:
+      return terms[0]
+    return lambda active: any(term(active) for term in terms)
+
+  def parseAnd(self):
+    terms = [self.parseNot()]
+    while self.peek() == "and":
+      self.next()
+      terms.append(self.parseNot())
+    if len(terms) == 1:
+      return terms[0]
+    return lambda active: all(term(active) for term in terms)
+
+  def parseNot(self):
+    if self.peek() == "not":
+      self.next()
+      term = self.parseNot()
+      return lambda active: not term(active)
+    return self.parseAtom()
+
+  def parseAtom(self):
+    token = self.next()
+    if token == "(":
+      term = self.parseOr()
+      if self.peek() != ")":
+        self.fail("missing ')'")
+      self.next()
+      return term
+    if token == ")" or token in self.KEYWORDS:
+      self.fail("unexpected '" + token + "'")
+    return lambda active: token in active
+
+class FlavorFilter:
+  """Decides which flavor lists are satisfied by the flavors of a run.
+
+  A list is satisfied if any of its expressions is true. Modules and links
+  tend to share a handful of lists, so the result of every distinct list is
+  kept and the rest of the run only pays a dict lookup.
+  """
+
+  def __init__(self, flavors, facts = ()):
+    self.active = frozenset(flavors) | frozenset(facts)
+    self.results = {}
+
+  def accepts(self, flavors):
+    """Checks a flavor list. None means there are no requirements."""
+    if flavors is None:
+      return True
+    key = tuple(flavors)
+    result = self.results.get(key)
+    if result is None:
+      result = self.results[key] = any(
+        FlavorExpression.get(text).evaluate(self.active) for text in key)
+    return result
+
+def flavorFacts(hostname = None):
+  """Returns the flavors that are implicitly active on a computer.
+
+  These are "os:" followed by the name of the operating system (like
+  "os:linux" or "os:darwin"), "host:" followed by the host name, both short
+  and fully qualified, and "arch:" followed by the machine type (like
+  "arch:x86_64").
+
+  @param hostname: The host name to use instead of the one of this computer.
+  """
+  import socket, platform
+  hostname = hostname or socket.gethostname()
+  facts = {"os:" + platform.system().lower(), "host:" + hostname,
+    "host:" + hostname.split(".")[0]}
+  machine = platform.machine().lower()
+  if machine:
+    facts.add("arch:" + machine)
+  return sorted(facts)
+
+def normalizeConfig(data, where):
+  """Validates the contents of a metaconfig.yaml file and fills defaults.
+
+  @param data: The parsed yaml file.
+  @param where: Name of the file, for error messages.
+
+  @return: A dict with every field of MODULE_FIELDS. Symlinks are dicts with
+    every field of LINK_FIELDS.
+
+  @raise ConfigError: If the file is not valid.
+  """
+  if data is None:
+    data = {}
+  for key in ["flavors", "exclude", "ignore", "depends_on"]:
+    if isinstance(data, dict) and isinstance(data.get(key), str):
+      data[key] = [data[key]]
+  errors = checkFields(data, MODULE_FIELDS, where)
+  if not isinstance(data, dict):
+    raise ConfigError(errors)
+  errors += checkStrategy(data, where)
+  for key in ["exclude", "ignore"]:
+    if isinstance(data.get(key), list):
+      errors += checkPatterns(data[key], where + ": " + key)
+  if isinstance(data.get("flavors"), list) and \
+      all(isinstance(text, str) for text in data["flavors"]):
+    errors += checkFlavors(data["flavors"], where)
+  links = data.get("symlinks")
+  if not isinstance(links, list):
+    links = []
+
+  config = {
+    "location": data.get("location") or "",
+    "prompt_location": data.get("prompt_location") or False,
+    "enabled": data.get("enabled") is not False,
+    # Infer links if there is no list of them, unless told otherwise.
+    "infer_symlinks": data.get("infer_symlinks", "symlinks" not in data),
+    "exclude": data.get("exclude") or [],
+    "ignore": data.get("ignore") or [],
+    "flavors": data.get("flavors"),
+    "symlinks": [],
+    "strategy": data.get("strategy") or STRATEGY_SYMLINK,
+    "depends_on": [os.path.normpath(name) for name in
+      data.get("depends_on") or []],
+  }
+  if "location" not in data or data["location"] is None:
+    config["prompt_location"] = True  # Cannot infer location
+  if config["infer_symlinks"] is None:
+    config["infer_symlinks"] = "symlinks" not in data
+
+  for i, link in enumerate(links):
+    link_where = where + ": symlink " + str(i + 1)
+    if isinstance(link, str):
+      link = {"file": link}
+    elif isinstance(link, dict) and isinstance(link.get("flavors"), str):
+      link["flavors"] = [link["flavors"]]
+    link_errors = checkFields(link, LINK_FIELDS, link_where)
+    if not link_errors and not link.get("file"):
+      link_errors.append(link_where + ": 'file' is missing or empty")
+    if not link_errors:
+      link_errors += checkStrategy(link, link_where)
+      link_errors += checkFlavors(link.get("flavors") or [], link_where)
+    if not link_errors and Matcher.isPattern(link["file"]):
+      link_errors += checkPatterns([link["file"]], link_where)
+      if os.sep in link["file"] and not link["file"].startswith(
+          Matcher.REGEX_PREFIX):
+        link_errors.append(link_where + ": patterns can only match the " +
+          "names of the entries in the module directory")
+      if link.get("target") is not None:
+        link_errors.append(link_where + ": 'target' can't be used with a " +
+          "pattern")
+    errors += link_errors
+    if not link_errors:
+      config["symlinks"].append({"file": link["file"],
+        "target": link.get("target"),
+        "enabled": link.get("enabled") is not False,
+        "flavors": link.get("flavors"),
+        "strategy": link.get("strategy")})
+  if errors:
+    raise ConfigError(errors)
+  return config
+
+# Names that are never installed unless they are listed explicitly.
+TEMP_PATTERNS = ["*.*~", "*.swp", ".DS_Store"]
+
+class Link:
+  """A symlink of a module, as described in its metaconfig.yaml file."""
+
+  __slots__ = ["file", "target", "enabled", "flavors", "strategy"]
+
+  def __init__(self, file, target = None, enabled = True, flavors = None,
+      strategy = None):
+    self.file = file
+    self.target = target
+    self.enabled = enabled
+    self.flavors = flavors
+    # None uses the strategy of the module.
+    self.strategy = strategy
+
+class Module:
+  """A module ready to be planned, with all its defaults filled in."""
+
+  __slots__ = ["name", "path", "config_name", "fingerprint", "location",
+    "prompt_location", "enabled", "infer_symlinks", "exclude", "ignore",
+    "flavors", "symlinks", "strategy", "depends_on"]
+
+  # Files in a module that are never installed.
+  IGNORED_FILES = ["metaconfig.yaml", "localmetaconfig.yaml"]
+
+  def __init__(self, name, path, config, names, config_name = None,
+      fingerprint = None):
+    """
+    @param name: Name of the module (its path relative to meta_dir).
+    @param path: Full path of the module directory.
+    @param config: The result of normalizeConfig().
+    @param names: Names of the entries in the module directory.
+    @param config_name: Name of the yaml file used, if any.
+    @param fingerprint: See moduleFingerprint().
+    """
+    self.name = name
+    self.path = path
+    self.config_name = config_name
+    self.fingerprint = fingerprint
+    self.location = config["location"]
+    self.prompt_location = config["prompt_location"]
+    self.enabled = config["enabled"]
+    self.infer_symlinks = config["infer_symlinks"]
+    self.exclude = config["exclude"]
+    self.ignore = config["ignore"]
+    self.flavors = config["flavors"]
+    self.strategy = config["strategy"]
+    self.depends_on = config["depends_on"]
+
+    # Patterns stand for every entry of the module directory they match.
+    ignored = Matcher.get(TEMP_PATTERNS + self.IGNORED_FILES + self.ignore)
+    links = []
+    for link in config["symlinks"]:
+      if not Matcher.isPattern(link["file"]):
+        links.append(Link(**link))
+        continue
+      pattern = Matcher.get([link["file"]])
+      links += [Link(**dict(link, file = x)) for x in names
+        if pattern.match(x) and not ignored.match(x)]
+    # Infer links from the files in the module
+    if self.infer_symlinks:
+      listed = set(link.file for link in links)
+      links += [Link(x) for x in names if not ignored.match(x) and
+        x not in listed]
+    excluded = Matcher.get(self.exclude)
+    self.symlinks = [link for link in links if not excluded.match(link.file)
+      and not excluded.match(os.path.basename(link.file.rstrip(os.sep)))]
+
+class ConfigCache:
+  """Normalized metaconfig.yaml files, saved between runs.
+
+  Entries are keyed by the digest of the contents of the file, so parsing and
+  validating a file that didn't change is a dictionary lookup.
+  """
+
+  # Bump this whenever the format or the checks of normalizeConfig() change.
+  VERSION = 5
+
+  def __init__(self, filename = None):
+    self.filename = filename
+    self.configs = {}
+    self.used = {}
+
+  def load(self):
+    try:
+      with open(self.filename, "r") as stream:
+        data = json.load(stream)
+      if data.get("version") == self.VERSION:
+        self.configs = data["configs"]
+    except (OSError, ValueError, KeyError, AttributeError):
+      self.configs = {}
+    return self
+
+  def save(self):
+    """Saves the entries used during this run."""
+    os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+    with open(self.filename + ".tmp", "w") as stream:
+      json.dump({"version": self.VERSION, "configs": self.used}, stream)
+    os.replace(self.filename + ".tmp", self.filename)
+
+  def get(self, contents, where):
+    """Returns the normalized config for the contents of a yaml file.
+
+    @raise ConfigError: If the file is not valid.
+    """
+    digest = hashlib.sha256(contents).hexdigest()
+    config = self.configs.get(digest)
+    if config is None:
+      config = normalizeConfig(loadYaml(contents, where), where)
+      self.configs[digest] = config
+    self.used[digest] = config
+    return config
+
+def loadYaml(stream, where):
+  """Parses a yaml document with the fastest safe loader available.
+
+  @param where: Name of the file, for error messages.
+  @raise ConfigError: If the document is not valid.
+  """
+  import yaml
+  # The C loader is much faster, but it's not always available.
+  loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+  try:
+    return yaml.load(stream, Loader = loader)
+  except yaml.YAMLError as e:
+    raise ConfigError([where + ": " + str(e).replace("\n", " ")])
+
+def loadModules(discovered, flavors, configs = None):
+  """Reads, validates and normalizes the configuration of every module.
+
+  Everything is checked before planning starts, so a broken metaconfig.yaml
+  stops the run before the user is asked anything.
+
+  @param discovered: The result of discoverModules().
+  @param flavors: The flavors used in this run, for the fingerprints.
+  @param configs: A ConfigCache. If None, every file is parsed.
+
+  @return: A list of Module objects.
+
+  @raise ConfigError: With every error found in every module.
+  """
+  if configs is None:
+    configs = ConfigCache()
+  modules = []
+  errors = []
+  for (module_name, module_meta_path, dir_names, file_names) in discovered:
+    contents = None
+    config_name = None
+    for name in ["localmetaconfig.yaml", "metaconfig.yaml"]:
+      if name in file_names:
+        config_name = name
+        with open(os.path.join(module_meta_path, name), 'rb') as stream:
+          contents = stream.read()
+        break
+    if config_name is None:
+      if os.sep in module_name:
+        continue
+      # For top level modules without metaconfig.yaml file, infer files and
+      # prompt for the location.
+      config = normalizeConfig({}, module_name)
+    else:
+      try:
+        config = configs.get(contents, os.path.join(module_name, config_name))
+      except ConfigError as e:
+        errors += e.errors
+        continue
+    names = dir_names + file_names
+    modules.append(Module(module_name, module_meta_path, config, names,
+      config_name, moduleFingerprint(module_name, contents, names, flavors)))
+  if errors:
+    raise ConfigError(errors)
+  return modules
+
+def orderModules(modules, meta_dir):
+  """Sorts modules so that they come after the modules they depend on.
+
+  Modules keep the order of discovery otherwise. Dependencies that are not
+  part of this run, like modules left out with -m, are assumed to be
+  installed already.
+
+  @return: The sorted list of Modules.
+  @raise ConfigError: If a dependency is not a module, or if there is a
+    cycle.
+  """
+  errors = []
+  for module in modules:
+    where = os.path.join(module.name, module.config_name or "")
+    for name in module.depends_on:
+      path = os.path.join(meta_dir, name)
+      if name == module.name or name.startswith(os.pardir) or \
+          os.path.isabs(name) or not os.path.isdir(path):
+        errors.append(where + ": depends on '" + name + "', which is not " +
+          "another module")
+  if errors:
+    raise ConfigError(errors)
+  by_name = {module.name: module for module in modules}
+  try:
+    names = sortByDependencies(list(by_name), {module.name: module.depends_on
+      for module in modules})
+  except ValueError as e:
+    raise ConfigError([str(e)])
+  return [by_name[name] for name in names]
+
+def sortByDependencies(names, dependencies):
+  """Sorts names so that every name comes after the names it depends on.
+
+  Names keep their order otherwise. Dependencies that are not in names are
+  ignored.
+
+  @param dependencies: Maps names to the lists of names they depend on.
+  @raise ValueError: If there is a cycle.
+  """
+  index = {name: i for i, name in enumerate(names)}
+  waiting = {name: set(d for d in dependencies.get(name, []) if d in index)
+    for name in names}
+  dependents = collections.defaultdict(list)
+  for name in names:
+    for dependency in waiting[name]:
+      dependents[dependency].append(name)
+  ready = [index[name] for name in names if not waiting[name]]
+  heapq.heapify(ready)
+  result = []
+  while ready:
+    name = names[heapq.heappop(ready)]
+    result.append(name)
+    for dependent in dependents[name]:
+      waiting[dependent].discard(name)
+      if not waiting[dependent]:
+        heapq.heappush(ready, index[dependent])
+  if len(result) < len(names):
+    # Everything left is waiting for something else that is left, so
+    # following the dependencies from any of them ends in a cycle.
+    path = []
+    name = next(name for name in names if waiting[name])
+    while name not in path:
+      path.append(name)
+      name = min(waiting[name], key = index.get)
+    raise ValueError("dependency cycle: " +
+      " -> ".join(path[path.index(name):] + [name]))
+  return result
+
+# Answers that apply to every module, and their types.
+ANSWER_FIELDS = {"install": bool, "mkdir": bool, "backup": bool,
+  "modules": dict}
+# Answers for a single module, and their types.
+MODULE_ANSWER_FIELDS = {"install": bool, "mkdir": bool, "backup": bool,
+  "location": str, "links": dict}
+
+class Answers:
+  """Precomputed answers to the questions asked while planning.
+
+  An answers file has a section with the answers for every computer, and
+  optional "flavors" and "hosts" sections that override it:
+
+    install: true
+    modules:
+      vim:
+        location: ~/
+        links:
+          .vimrc: ~/.vimrc.shared
+          .gvimrc: null
+    flavors:
+      work:
+        backup: false
+    hosts:
+      "build-*":
+        mkdir: false
+
+  Flavors are applied in the order given with -f, then the hosts whose
+  pattern matches the name of this computer. A null link destination skips
+  that link. Questions without an answer are asked as usual, or answered
+  with the default if --non-interactive is used.
+  """
+
+  def __init__(self):
+    self.defaults = {}
+    self.modules = {}
+
+  @staticmethod
+  def load(filename, flavors = (), hostname = None):
+    """Reads the answers for this computer from filename.
+
+    @raise ConfigError: If the file is not valid.
+    @raise OSError: If the file can't be read.
+    """
+    with open(expandPath(filename), 'rb') as stream:
+      data = loadYaml(stream, filename)
+    if data is None:
+      data = {}
+    if hostname is None:
+      import socket
+      hostname = socket.gethostname()
+    sections = [(filename, data)]
+    errors = []
+    if isinstance(data, dict):
+      data = dict(data)
+      flavor_sections = data.pop("flavors", None) or {}
+      host_sections = data.pop("hosts", None) or {}
+      for name, section in [("flavors", flavor_sections),
+          ("hosts", host_sections)]:
+        if not isinstance(section, dict):
+          errors.append(filename + ": '" + name + "' should be a dict")
+      if not errors:
+        sections[0] = (filename, data)
+        for flavor in flavors:
+          if flavor in flavor_sections:
+            sections.append((filename + ": flavors: " + flavor,
+              flavor_sections[flavor]))
+        for pattern, section in host_sections.items():
+          if fnmatch.fnmatch(hostname, str(pattern)) or \
+              fnmatch.fnmatch(hostname.split(".")[0], str(pattern)):
+            sections.append((filename + ": hosts: " + str(pattern), section))
+
+    answers = Answers()
+    for where, section in sections:
+      errors += answers.merge(section, where)
+    if errors:
+      raise ConfigError(errors)
+    return answers
+
+  def merge(self, section, where):
+    """Adds the answers in section, overriding the existing ones.
+
+    @return: A list of errors, empty if the section is valid.
+    """
+    if section is None:
+      return []
+    errors = checkFields(section, ANSWER_FIELDS, where)
+    if errors:
+      return errors
+    for key, value in section.items():
+      if key != "modules" and value is not None:
+        self.defaults[key] = value
+    for name, module in (section.get("modules") or {}).items():
+      module_where = where + ": modules: " + str(name)
+      if module is None:
+        continue
+      module_errors = checkFields(module, MODULE_ANSWER_FIELDS, module_where)
+      if module_errors:
+        errors += module_errors
+        continue
+      for file, dest in (module.get("links") or {}).items():
+        if dest is not None and not isinstance(dest, str):
+          errors.append(module_where + ": links: '" + str(file) +
+            "' should be a path or null")
+      answers = self.modules.setdefault(str(name), {"links": {}})
+      for key, value in module.items():
+        if key == "links":
+          for file, dest in (value or {}).items():
+            answers["links"][expandPath(str(file)).rstrip(os.sep)] = dest
+        elif value is not None:
+          answers[key] = value
+    return errors
+
+  def get(self, module_name, key):
+    """Returns the answer to key for a module, or None to ask the user."""
+    module = self.modules.get(module_name, {})
+    if module.get(key) is not None:
+      return module[key]
+    return self.defaults.get(key)
+
+  def linkPath(self, module_name, filename):
+    """Returns where a link should go.
+
+    @return: (True, path) if the answers have a destination for filename,
+      where path is None if the link should be skipped. (False, None)
+      otherwise.
+    """
+    links = self.modules.get(module_name, {}).get("links", {})
+    if filename not in links:
+      return False, None
+    return True, links[filename]
+
+  def destinations(self, module_name):
+    """Returns the link destinations given for a module, unexpanded."""
+    links = self.modules.get(module_name, {}).get("links", {})
+    return sorted(path for path in links.values() if path is not None)
+
+  def digest(self, module_name):
+    """Digest of every answer that applies to a module.
+
+    The defaults for every module are included, since they apply unless the
+    module has its own answers.
+    """
+    answers = {key: self.get(module_name, key)
+      for key in MODULE_ANSWER_FIELDS if key != "links"}
+    answers["links"] = self.modules.get(module_name, {}).get("links", {})
+    return hashlib.sha256(json.dumps(answers, sort_keys = True).encode()) \
+      .hexdigest()
+
+def planModules(context, meta_dir, hashes = None, store = None, state = None,
+    configs = None, modules = None, answers = None, target = None):
+  """Walks all the modules in meta_dir and computes the plan to install them.
 
-  args = parser.parse_args()
+  This is the only place where the user is prompted. Nothing is changed in
+  the filesystem, that is left to applyPlan().
 
-  ignored_files = ["metaconfig.yaml", "localmetaconfig.yaml"]
+  @param context: The Context of the run.
+  @param meta_dir: The metaconfig directory.
+  @param hashes: The HashCache used to compare files with their backups.
+  @param store: The BackupStore for backups, None to use .bakN files.
+  @param state: The State of the last run. With --incremental, modules that
+    didn't change since then are skipped.
+  @param configs: The ConfigCache used to load metaconfig.yaml files.
+  @param modules: The modules to plan, as returned by loadModules(). If None,
+    they are discovered and loaded from meta_dir.
+  @param answers: The Answers used instead of prompting, if any.
+  @param target: The Target to install into, None for this computer.
 
-  if args.dry_run:
-    printWithDelay("DRY RUN. No changes will be made to the filesystem.", error=True)
-  else:
-    printWithDelay("Please review filenames carefully.", error=True)
+  @return: A Plan with every action needed to install the selected modules.
 
+  @raise ConfigError: If any of the selected modules is not valid.
+  """
+  plan = Plan(meta_dir, context.args.flavors)
+  plan.hashes = hashes
+  plan.store = store
+  if answers is not None:
+    plan.answers = answers
+  plan.target = target
+  plan.flavor_filter = FlavorFilter(context.args.flavors,
+    flavorFacts(target.name if target is not None else None))
 
-  for (module_meta_path, dir_name, file_names) in os.walk(meta_dir):
-    module_meta_path = expandPath(module_meta_path)
+  if modules is None:
+    with context.profiler.span("discovery", "phase") as span:
+      discovered = discoverModules(meta_dir, context.args.modules,
+        context.args.exclude_modules)
+    context.message("Found " + str(len(discovered)) + " directories in " +
+      "%.3f" % span.duration + " seconds.")
+    context.output.record(action = "discovery", directories = len(discovered),
+      duration = span.duration)
+    with context.profiler.span("load", "phase"):
+      modules = loadModules(discovered, context.args.flavors, configs)
 
-    common_prefix = os.path.commonprefix([module_meta_path, meta_dir])
-    module_name = os.path.relpath(module_meta_path, common_prefix)
+  # Modules are planned, and asked about, after the modules they depend on.
+  modules = orderModules(modules, meta_dir)
+  for module in modules:
+    if module.depends_on:
+      plan.dependencies[module.name] = module.depends_on
 
-    # Ignore the config dir itself
-    if module_meta_path is meta_dir:
-      continue
+  for module in modules:
+    with context.profiler.span(module.name, "module"):
+      planModule(context, module, plan, state)
 
-    module = None
+  plan.checkConflicts()
+  return plan
 
-    # Ignore modules not listed as parameters, ignored ones, and hidden ones.
-    if len(args.modules) > 0 and module_name not in args.modules: continue
-    if module_name in args.exclude_modules: continue
-    if module_name.startswith("."): continue
+def planModule(context, module, plan, state = None):
+  """Adds the actions needed to install a module to plan.
 
-    if "localmetaconfig.yaml" in file_names:
-      stream = open(module_meta_path + "/localmetaconfig.yaml", 'r')
-    elif "metaconfig.yaml" in file_names:
-      stream = open(module_meta_path + "/metaconfig.yaml", 'r')
-    else:
-      if os.sep in module_name:
-        continue
-      # For top level modules without metaconfig.yaml file, infer files and
-      # prompt for the location.
-      module = {"location": "", "prompt_location": True, "infer_symlinks": True}
+  @param module: The Module to plan.
+  @param plan: The Plan being computed.
+  @param state: The State of the last run, see planModules().
+  """
+  context.message("\n--- Module: " + module.name + " ---")
 
-    # Load it's yaml file.
-    if module is None:
-      module = yaml.load(stream)
+  # The answers and the environment decide where the links go, so they are
+  # part of the inputs too.
+  location = plan.answers.get(module.name, "location")
+  if location is None:
+    location = module.location
+  h = hashlib.sha256(module.fingerprint.encode() + b"\0" +
+    plan.answers.digest(module.name).encode())
+  for path in [location] + [link.file for link in module.symlinks] + \
+      plan.answers.destinations(module.name):
+    h.update(b"\0" + os.fsencode(plan.resolver.expand(path)))
+  fingerprint = h.hexdigest()
 
-    printWithDelay("\n--- Module: " + module_name + " ---")
-    if "localmetaconfig.yaml" in file_names:
-      printWithDelay(" - Using localmetaconfig.yaml")
-    elif "metaconfig.yaml" in file_names:
-      printWithDelay(" - Using metaconfig.yaml")
+  # Nothing to do if neither the module, its answers nor its links changed.
+  if context.args.incremental and state is not None and \
+      state.unchanged(module.name, fingerprint):
+    context.message(" - Unchanged since the last run. Skipping.")
+    context.output.record(action = "module", module = module.name,
+      status = "skipped", reason = "unchanged")
+    return
 
-    # Should we skip this one?
-    if ("enabled" in module and module["enabled"] is False):
-      printWithDelay(" - Module not enabled. Skipping.")
-      continue
+  if module.config_name is not None:
+    context.message(" - Using " + module.config_name)
 
-    # Check the flavors.
-    if "flavors" in module:
-      # If these lists don't intersect, just skip the module.
-      if not set(args.flavors) & set(module["flavors"]):
-        printWithDelay(" - Module has flavor requirements. Skipping because " +
-          "we are not running with the correct flavors.")
-        continue
+  # Should we skip this one?
+  if not module.enabled:
+    context.message(" - Module not enabled. Skipping.")
+    context.output.record(action = "module", module = module.name,
+      status = "skipped", reason = "disabled")
+    plan.fingerprints[module.name] = fingerprint
+    return
 
-    # Prompt location or infer it?
-    if not "prompt_location" in module:
-      module["prompt_location"] = False
-    if not "location" in module:
-      module["location"] = ""
-      module["prompt_location"] = True  # Cannot infer location
+  # Check the flavors.
+  if not plan.flavor_filter.accepts(module.flavors):
+    context.message(" - Module has flavor requirements. Skipping because " +
+      "we are not running with the correct flavors.")
+    context.output.record(action = "module", module = module.name,
+      status = "skipped", reason = "flavors")
+    plan.fingerprints[module.name] = fingerprint
+    return
 
-    # Infer links from the files in the module
-    if not "symlinks" in module or "infer_symlinks" in module and \
-        module["infer_symlinks"]:
-      if not "symlinks" in module:
-        module["symlinks"] = []
-      infered_links = os.listdir(module_meta_path)
-      infered_links = [x for x in infered_links if not isTempFile(x) and
-        x not in ignored_files]
-      module["symlinks"] = list(set(module["symlinks"] + infered_links))
-
-    if not "symlinks" in module or len(module["symlinks"]) == 0:
-      printWithDelay("This module contains no files. Skipping.")
-      continue
+  if len(module.symlinks) == 0:
+    context.message("This module contains no files. Skipping.")
+    context.output.record(action = "module", module = module.name,
+      status = "skipped", reason = "empty")
+    plan.fingerprints[module.name] = fingerprint
+    return
 
-    # Print a list of links to be installed and ask the user if the module
-    # should be installed.
-    if "location" in module and module["location"].strip():
-      printWithDelay("This module will install the following files at: " +
-          module["location"])
-    else:
-      printWithDelay("This module will install the following files: ")
-    for link in module["symlinks"]:
-      if isinstance(link, str):
-        printWithDelay(" - " + link)
-      else:
-        if not "file" in link:
-          printWithDelay(" - [unnamed] -  This will throw an error!")
-        else:
-          printWithDelay(" - " + link["file"])
-    if not promptYesNo("Install this module?"):
-      continue
+  # Print a list of links to be installed and ask the user if the module
+  # should be installed.
+  if module.location.strip():
+    context.message("This module will install the following files at: " +
+        module.location)
+  else:
+    context.message("This module will install the following files: ")
+  for link in module.symlinks:
+    context.message(" - " + link.file)
+  if not promptAnswer(context, plan, module.name, "install",
+      "Install this module?"):
+    context.output.record(action = "module", module = module.name,
+      status = "skipped", reason = "declined")
+    return
 
-    # Should we prompt for the location?
-    if "prompt_location" in module and module["prompt_location"]:
-        printWithDelay("Please provide the base path for this module.")
-        location = promptPath(None, module["location"])
-        if location is not None and location.strip():
-          module["location"] = location
+  # Should we prompt for the location?
+  location = plan.answers.get(module.name, "location")
+  if location is not None:
+    context.message(" - Location from the answers file: " + location)
+    module.location = location
+  elif module.prompt_location:
+    context.message("Please provide the base path for this module.")
+    location = promptPath(context, None, module.location)
+    if location is not None and location.strip():
+      module.location = location
 
-    # Install symlinks
-    if "symlinks" in module:
-      for link in module["symlinks"]:
-        result = installSymlink(link, module, module_meta_path, meta_dir)
+  # Plan symlinks
+  context.output.record(action = "module", module = module.name,
+    status = "planned", location = module.location)
+  plan.fingerprints[module.name] = fingerprint
+  for link in module.symlinks:
+    with context.profiler.span(os.path.join(module.name, link.file), "link",
+        module = module.name):
+      planSymlink(context, link, module, plan)
 
-  printWithDelay("\n    ------ Done ------\n")
-  return 0
+def planSymlink(context, link, module, plan):
+  """Figures out what needs to happen to install a single symlink.
 
-def installSymlink(symlink, module, module_meta_path, meta_dir):
-  global args
-  basepath = ""
-  if "location" in module:
-    basepath = module["location"]
+  The resulting actions are added to plan. The filesystem is only inspected,
+  never modified.
 
-  if isinstance(symlink, str):
-    filename = symlink
-  else:
-    if not "file" in symlink:
-      printWithDelay("Error: Symlink as a dict without a 'symlink' field.",
-        error = True)
-      return "error"
-    filename = symlink["file"]
+  @param link: The Link to install.
+  @param module: The Module it belongs to.
+  @param plan: The Plan being computed.
 
-    # Should we skip this one?
-    if "enabled" in symlink and symlink["enabled"] is False:
-      printWithDelay("Symlink not enabled. Skipping.")
-      return
+  @return: "ok" or "error".
+  """
+  basepath = module.location
+  filename = link.file
 
-    # Check the flavors.
-    if "flavors" in symlink:
-      # If this lists don't intersect, just skip the symlink.
-      if not set(args.flavors) & set(symlink["flavors"]):
-        printWithDelay(" - Symlink has flavor requirements. Skipping because " +
-          "we are not running with the correct flavors.")
-        return "ok"
-
-  if filename is "":
-    printWithDelay(TextColors.ERROR, end='')
-    printWithDelay("Error: Found empty filename for symlink.")
-    printWithDelay(TextColors.END, end='')
-    return "error"
+  # Should we skip this one?
+  if not link.enabled:
+    context.message("Symlink not enabled. Skipping.")
+    return "ok"
+
+  # Check the flavors.
+  if not plan.flavor_filter.accepts(link.flavors):
+    context.message(" - Symlink has flavor requirements. Skipping because " +
+      "we are not running with the correct flavors.")
+    return "ok"
 
   # Add a slash at the end.
   if basepath[-1:] != os.sep:
     basepath += os.sep
 
-  filename = expandPath(filename)
-  basepath = expandPath(basepath)
+  resolver = plan.resolver
+  filename = resolver.expand(filename)
+  basepath = resolver.expand(basepath)
 
   # Take out the last "/" if it's the last character so that split works
   # correctly.
-  if filename[-1:] is os.sep:
+  if filename[-1:] == os.sep:
     filename = filename[:-1]
 
   # We do this because the filename may add to the basepath, or override it.
@@ -262,85 +2540,659 @@ def installSymlink(symlink, module, module_meta_path, meta_dir):
   old_filename = filename
   middle, filename = os.path.split(filename)
 
-  # If the module contains a exclude list, make sure that this file is not in
-  # it. this has to happen after the cleanup to get a clean filename.
-  if "exclude" in module:
-    if filename in module["exclude"] or old_filename in module["exclude"]:
-      printWithDelay(" - Skipping " + filename  + " because it's on the " +
-        "exclude list for this module.")
-
-  target = os.path.join(module_meta_path, middle, filename)
-  # Target may be explicitly defined. The type check is to avoid hits when the
-  # string contains "target" as a substring.
-  if not isinstance(symlink, str) and "target" in symlink:
-    target = expandPath(os.path.join(module_meta_path, symlink["target"]))
-
-  printWithDelay("Installing symlink: " + old_filename)
+  target = os.path.join(module.path, middle, filename)
+  # Target may be explicitly defined.
+  if link.target is not None:
+    target = resolver.expand(os.path.join(module.path, link.target))
 
   # Make sure we have a file of the same name in the metaconfig folder.
-  if not os.path.lexists(target):
-    printWithDelay(" - Error: No matching element for " + filename + " at " +
-      target, error = True)
-    printWithDelay(" - This would create a broken symlink. Skipping this " +
-      "element.", error = True)
+  if resolver.mode(target) is None:
+    plan.add(ACTION_ERROR, module.name, target = target,
+      message = "No matching element for " + old_filename + " at " + target +
+        ". This would create a broken symlink.")
+    return "error"
+
+  # Symlinks are the default. Other strategies are saved in the actions.
+  strategy = link.strategy or module.strategy
+  how = {} if strategy == STRATEGY_SYMLINK else {"strategy": strategy}
+  if strategy == STRATEGY_HARDLINK and resolver.isdir(target):
+    plan.add(ACTION_ERROR, module.name, target = target,
+      message = "Directories can't be hard linked: " + target)
     return "error"
 
-  # Figure out where should we install thsi symlink
-  path = getFullPath(basepath, middle, filename, meta_dir)
+  # Figure out where should we install this symlink
+  answered, path = plan.answers.linkPath(module.name, old_filename)
+  if not answered or path is not None:
+    path = getFullPath(context, basepath, middle, filename, plan.meta_dir,
+      module.name, plan, path)
   if path is None:
-    print (" - Skipping " + filename)
+    context.message(" - Skipping " + filename)
     return "ok"
+  # Plans may be applied from a different working directory.
+  path = os.path.abspath(path)
 
   # If the file is already a symlink to where we want it, do nothing.
   # This possibly means this tool ran before.
-  if os.path.islink(path):
+  if plan.target is not None and strategy == STRATEGY_SYMLINK:
+    # Links in a root point to the repository as seen from inside it, so
+    # they can't be resolved from here.
+    target = os.path.join(plan.target.repo,
+      os.path.relpath(target, plan.meta_dir))
+  mode = resolver.mode(path)
+  if strategy != STRATEGY_SYMLINK:
+    # Copies are only installed again if they changed.
+    if mode is not None and isInstalled(path, target, strategy, plan.hashes):
+      plan.add(ACTION_NOOP, module.name, path = path, target = target, **how)
+      return "ok"
+  elif mode is not None and stat.S_ISLNK(mode):
+    if os.readlink(path) == target:
+      plan.add(ACTION_NOOP, module.name, path = path, target = target)
+      return "ok"
     real_path = os.path.realpath(path)
-    if os.path.lexists(real_path) and os.path.samefile(real_path, target):
-      printWithDelay(" - Symlink already present. Skipping.")
+    if plan.target is None and os.path.lexists(real_path) and \
+        os.path.samefile(real_path, target):
+      plan.add(ACTION_NOOP, module.name, path = path, target = target)
       return "ok"
 
-  # Get the backup info
-  need_backup = os.path.lexists(path)
-  current_backup = None
-  next_backup = None
-  if need_backup:
-    current_backup, next_backup = getBackupPaths(path)
-    if current_backup is not None:
-      # Check if we need to create a backup by comparing the file with most
-      # recent backup, we do this differently if its just a file or a dir, but
-      # in both cases we asssume they are equal if the names and contents are
-      # the same (recursively).
-      if os.path.isdir(target):
-        need_backup = not compareDirs(target, current_backup)
+  if mode is None:
+    plan.add(ACTION_LINK, module.name, path = path, target = target, **how)
+    return "ok"
+
+  if plan.answers.get(module.name, "backup") is False:
+    context.message(" - Leaving " + path + " alone, backups are disabled " +
+      "in the answers file.")
+    return "ok"
+
+  # There is something in the way, so it needs to be backed up. There is no
+  # need to create a new backup if the most recent one is identical, in
+  # which case the existing element is simply replaced.
+  if plan.store is not None:
+    latest = plan.store.latest(path)
+    current_backup = next_backup = None
+    if latest is not None:
+      current_backup = STORE_PREFIX + latest["digest"]
+    try:
+      next_backup = STORE_PREFIX + plan.store.hashes.digest(path)
+    except OSError:
+      next_backup = STORE_PREFIX
+    if next_backup == current_backup:
+      next_backup = None
+    plan.add(ACTION_BACKUP_LINK, module.name, path = path, target = target,
+      backup = next_backup, current_backup = current_backup, **how)
+    return "ok"
+
+  current_backup, next_backup = getBackupPaths(path, plan.backups)
+  if current_backup is not None:
+    with context.profiler.span(path, "compare", backup = current_backup):
+      if sameContents(path, current_backup, plan.hashes, context.args.jobs):
+        next_backup = None
+  if next_backup is not None:
+    plan.backups.add(path, int(next_backup[next_backup.rindex(".bak") + 4:]))
+    if plan.hashes is not None:
+      plan.hashes.move(path, next_backup)
+  prune = []
+  if context.args.keep_backups is not None:
+    prune = plan.backups.prune(path, context.args.keep_backups)
+  plan.add(ACTION_BACKUP_LINK, module.name, path = path, target = target,
+    backup = next_backup, current_backup = current_backup, prune = prune,
+    **how)
+  return "ok"
+
+def printPlan(context, plan):
+  """Prints every action in the plan as a short diff-like summary."""
+  context.message("\n--- Plan ---")
+  counts = {}
+  for action in plan.actions:
+    kind = action["action"]
+    counts[kind] = counts.get(kind, 0) + 1
+    recordAction(context, action, status = "planned", duration = None)
+    how = ""
+    if "strategy" in action:
+      how = " (" + action["strategy"] + ")"
+    if kind == ACTION_NOOP:
+      context.message("  = " + action["path"] + " -> " + action["target"] + how)
+    elif kind == ACTION_LINK:
+      context.message("  + " + action["path"] + " -> " + action["target"] + how)
+    elif kind == ACTION_BACKUP_LINK:
+      note = how
+      if action["backup"] is not None:
+        note += " (backup: " + action["backup"] + ")"
+      else:
+        note += " (exact backup already present: " + \
+          action["current_backup"] + ")"
+      if action.get("prune"):
+        note += " (removes " + str(len(action["prune"])) + " old backups)"
+      context.message("  ~ " + action["path"] + " -> " + action["target"] +
+        note)
+    elif kind == ACTION_MKDIR:
+      context.message("  + " + action["path"] + os.sep)
+    elif kind == ACTION_ERROR:
+      context.message("  ! [" + action["module"] + "] " + action["message"],
+        error = True)
+  summary = ", ".join(str(counts[kind]) + " " + kind for kind in
+    [ACTION_MKDIR, ACTION_LINK, ACTION_BACKUP_LINK, ACTION_NOOP, ACTION_ERROR]
+    if kind in counts)
+  context.message("Summary: " + (summary or "nothing to do"))
+
+def applyPlan(context, plan, jobs = 1, store = None, journal = None):
+  """Applies every action in the plan.
+
+  With more than one job, directories are created first and then the links
+  are installed concurrently on a pool of threads. This is safe because
+  planning guarantees that no two links touch the same path (see
+  Plan.checkConflicts()). The links of a module are only started once the
+  links of every module it depends on are done, and they are skipped if any
+  of those failed. Output is always printed in the order of the plan.
+
+  @param context: The Context of the run.
+  @param plan: The Plan to apply.
+  @param jobs: Number of links to install at the same time.
+  @param store: The BackupStore, needed if the plan has backups in the store.
+  @param journal: The Journal where every change is recorded, if any.
+
+  @return: The list of results ("ok" or "error"), one per action.
+  """
+  actions = plan.actions
+  logs = [[] for _ in actions]
+  prerequisites = plan.prerequisites()
+  # Modules with an action that failed or was skipped.
+  failed = set()
+
+  spans = [None] * len(actions)
+
+  def run(i):
+    action = actions[i]
+    spans[i] = context.profiler.span(action["action"] + " " +
+      action.get("path", action["module"]), "action", module = action["module"])
+    with spans[i]:
+      broken = sorted(prerequisites.get(action["module"], set()) & failed)
+      if broken:
+        logs[i].append(("Skipping " + action.get("path", action["module"]) +
+          ": it depends on " + ", ".join(broken) + ", which failed.", True))
+        result = "error"
+      else:
+        result = applyAction(action, logs[i], store, journal)
+    if action["action"] == ACTION_MKDIR:
+      plan.resolver.created(action["path"])
+    if result != "ok":
+      failed.add(action["module"])
+    return result
+
+  results = {}
+  futures = {}
+  pool = None
+  if jobs > 1:
+    for i, action in enumerate(actions):
+      if action["action"] == ACTION_MKDIR:
+        results[i] = run(i)
+    import concurrent.futures
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers = jobs)
+    futures = {i: concurrent.futures.Future() for i in range(len(actions))
+      if i not in results}
+    scheduleModules(plan, futures, prerequisites, pool, run)
+
+  try:
+    for i in range(len(actions)):
+      if i in futures:
+        results[i] = futures[i].result()
+      elif i not in results:
+        results[i] = run(i)
+      for text, error in logs[i]:
+        context.message(text, error = error)
+      metrics = {"status": results[i], "duration": spans[i].duration}
+      if spans[i].calls is not None:
+        metrics["calls"] = spans[i].calls
+      for hook in context.action_hooks:
+        hook(actions[i], metrics)
+      recordAction(context, actions[i], **metrics)
+  finally:
+    if pool is not None:
+      pool.shutdown()
+  return [results[i] for i in range(len(actions))]
+
+def scheduleModules(plan, futures, prerequisites, pool, run):
+  """Runs actions on pool as soon as the modules they depend on are done.
+
+  @param futures: Maps the index of every action to run to a Future that
+    gets its result.
+  @param prerequisites: See Plan.prerequisites().
+  @param run: Called with the index of an action, returns its result.
+  """
+  actions = plan.actions
+  by_module = collections.OrderedDict()
+  for i in futures:
+    by_module.setdefault(actions[i]["module"], []).append(i)
+  # Number of unfinished actions of every module.
+  left = {name: len(indexes) for name, indexes in by_module.items()}
+  names = set(by_module)
+  waiting = {name: prerequisites.get(name, set()) & names
+    for name in by_module}
+  dependents = collections.defaultdict(list)
+  for name in by_module:
+    for other in waiting[name]:
+      dependents[other].append(name)
+  lock = threading.Lock()
+
+  def start(name):
+    for i in by_module[name]:
+      pool.submit(run, i).add_done_callback(
+        lambda future, i = i: finish(i, future))
+
+  def finish(i, future):
+    name = actions[i]["module"]
+    ready = []
+    with lock:
+      left[name] -= 1
+      if left[name] == 0:
+        for other in dependents[name]:
+          waiting[other].discard(name)
+          if not waiting[other]:
+            ready.append(other)
+    for other in ready:
+      start(other)
+    if future.exception() is not None:
+      futures[i].set_exception(future.exception())
+    else:
+      futures[i].set_result(future.result())
+
+  for name in [name for name in by_module if not waiting[name]]:
+    start(name)
+
+def recordAction(context, action, **fields):
+  """Writes the structured log record for a planned action."""
+  context.output.record(action = action["action"], module = action["module"],
+    path = action.get("path"), target = action.get("target"),
+    backup = action.get("backup"), message = action.get("message"),
+    strategy = action.get("strategy"), **fields)
+
+def applyAction(action, log, store = None, journal = None):
+  """Performs a single planned action on the filesystem.
+
+  The plan may have been computed a while ago, or on a different computer, so
+  the preconditions are checked again before changing anything. This may run
+  on a worker thread, so messages are appended to log as (text, error) tuples
+  instead of being printed.
+
+  Every change is written to the journal before it's made. Elements in the
+  way are replaced atomically, and if anything fails the action is undone,
+  so the path is never left empty.
+
+  @return: "ok" or "error".
+  """
+  def say(text, error = False):
+    log.append((text, error))
+
+  if journal is None:
+    journal = Journal()
+
+  kind = action["action"]
+  if kind == ACTION_ERROR:
+    say("Error: [" + action["module"] + "] " + action["message"], error = True)
+    return "error"
+
+  path = action["path"]
+  if kind == ACTION_MKDIR:
+    # Remember which directories didn't exist, so they can be removed again.
+    created = []
+    parent = path
+    while parent and not os.path.isdir(parent):
+      created.append(parent)
+      parent = os.path.dirname(parent) if parent != os.sep else None
+    entry = journal.begin(action, created = created)
+    try:
+      os.makedirs(path, exist_ok=True)
+      journal.done(entry)
+      say(" - Created directory: " + path)
+      return "ok"
+    except OSError:
+      say(" - Failed to create directory: " + path, error = True)
+      say(" - Do we have the right permissions?", error = True)
+      journal.done(entry, status = "error")
+      return "error"
+
+  target = action["target"]
+  strategy = action.get("strategy", STRATEGY_SYMLINK)
+  if strategy == STRATEGY_SYMLINK:
+    say("Installing symlink: " + path)
+  else:
+    say("Installing " + path + " (" + strategy + ")")
+  if kind == ACTION_NOOP:
+    say(" - Already present. Skipping.")
+    return "ok"
+
+  backup = action.get("backup")
+  if kind == ACTION_BACKUP_LINK and backup is not None and \
+      backup.startswith(STORE_PREFIX) and store is None:
+    say(" - Error: This plan needs the backup store (--backup-store).",
+      error = True)
+    return "error"
+  if kind == ACTION_BACKUP_LINK and backup is not None and \
+      not backup.startswith(STORE_PREFIX) and os.path.lexists(backup):
+    say(" - Error: Backup path already exists: " + backup, error = True)
+    return "error"
+
+  # Here we go. Back up the element in the way and replace it with a symlink.
+  entry = journal.begin(action)
+  record = None
+  # A directory that is already backed up is moved here until it's replaced.
+  trash = None
+  try:
+    if kind == ACTION_LINK:
+      try:
+        if strategy != STRATEGY_SYMLINK and os.path.lexists(path):
+          raise FileExistsError(errno.EEXIST, "File exists", path)
+        if strategy == STRATEGY_SYMLINK:
+          os.symlink(target, path)
+        else:
+          installElement(target, path, strategy)
+      except FileExistsError:
+        say(" - Error: " + path + " was created after the plan was " +
+          "computed. Skipping.", error = True)
+        journal.done(entry, status = "error")
+        return "error"
+    else:
+      # Directories can't be replaced atomically, so they are moved away
+      # first. The same goes for anything a directory replaces.
+      is_dir = os.path.isdir(path) and not os.path.islink(path) or \
+        strategy != STRATEGY_SYMLINK and os.path.isdir(target)
+      if backup is not None and backup.startswith(STORE_PREFIX):
+        # The store links to the original, which stays in place until the
+        # backup is recorded.
+        record = store.add(path)
+        journal.done(entry, status = "backup", record = record)
+        say(" - Creating backup: " + STORE_PREFIX + record["digest"])
+        if is_dir:
+          trash = tempPath(path, "old")
+          os.rename(path, trash)
+      elif backup is not None:
+        say(" - Creating backup: " + backup)
+        if is_dir:
+          os.rename(path, backup)
+        else:
+          # A second link keeps the original in place until it's replaced.
+          try:
+            os.link(path, backup, follow_symlinks = False)
+          except OSError:
+            os.rename(path, backup)
       else:
-        need_backup = not filecmp.cmp(target, current_backup)
+        say(" - Exact backup already present: " + action["current_backup"])
+        if is_dir:
+          trash = tempPath(path, "old")
+          os.rename(path, trash)
+      installElement(target, path, strategy)
+    journal.done(entry)
+    say(" - Installed successfuly.")
+  except OSError:
+    say(" - Error creating symlink from: " + path , error = True)
+    say(" - To: " + target , error = True)
+    say(" - Do we have the correct permissions?", error = True)
+    try:
+      if trash is not None and not os.path.lexists(path):
+        os.rename(trash, path)
+      undoAction(action, store, record)
+      journal.done(entry, status = "undone")
+      say(" - Restored " + path + " as it was.", error = True)
+    except OSError:
+      journal.done(entry, status = "error")
+      say(" - Could not restore " + path + ". Use --rollback to try again.",
+        error = True)
+    return "error"
+
+  if trash is not None:
+    try:
+      removePath(trash)
+    except OSError:
+      say(" - Failed to remove " + trash + ", it's already backed up.",
+        error = True)
+
+  for old_backup in action.get("prune", []):
+    try:
+      removePath(old_backup)
+      say(" - Removed old backup: " + old_backup)
+    except OSError:
+      say(" - Failed to remove old backup: " + old_backup, error = True)
+  return "ok"
 
-  # Here we go. Rename the file to the backup and replace it with a symlink.
+def installElement(target, path, strategy = STRATEGY_SYMLINK):
+  """Atomically replaces the file or symlink at path with target.
+
+  The new element is created next to path with a temporary name and renamed
+  over it, so there is always something at path. path can't be a directory.
+
+  @param strategy: How to install target, see STRATEGIES.
+  """
+  temp = tempPath(path)
   try:
-    if need_backup:
-      printWithDelay(" - Creating backup: " + next_backup)
-      if not args.dry_run:
-        shutil.move(path, next_backup)
+    if strategy == STRATEGY_SYMLINK:
+      os.symlink(target, temp)
+    elif strategy == STRATEGY_HARDLINK:
+      os.link(target, temp)
     else:
-      if current_backup is not None:
-        printWithDelay(" - Exact backup already present: " + current_backup)
-    if not args.dry_run:
-        os.symlink(target, path)
-    printWithDelay(" - Installed symlink successfuly.")
-  except IOError:
-    printWithDelay(" - Error creating symlink from: " + path , error = True)
-    printWithDelay(" - To: " + target , error = True)
-    printWithDelay(" - Do we have the correct permissions?", error = True)
-
-def getFullPath(basepath, middle, filename, meta_dir):
-  global args
-  if not os.path.normpath(basepath).strip():
+      copy = copyFile if strategy == STRATEGY_COPY else cloneFile
+      if os.path.isdir(target):
+        copyTree(target, temp, copy)
+      else:
+        copy(target, temp)
+    os.replace(temp, path)
+  except OSError:
+    if os.path.lexists(temp):
+      removePath(temp)
+    raise
+
+def tempPath(path, kind = "new"):
+  """Returns a hidden name next to path, unique to this thread and kind."""
+  parent, name = os.path.split(path)
+  return os.path.join(parent, "." + name + ".metaconfig-" + kind + "-" +
+    str(os.getpid()) + "-" + str(threading.get_ident()))
+
+def isInstalled(path, target, strategy = STRATEGY_SYMLINK, hashes = None):
+  """Checks if path is target, as installed with strategy.
+
+  Symlinks have to point to target, hard links have to be the same file and
+  copies need the same contents.
+  """
+  if strategy == STRATEGY_SYMLINK:
+    try:
+      return os.readlink(path) == target
+    except OSError:
+      return False
+  try:
+    st = os.lstat(path)
+    target_st = os.stat(target)
+  except OSError:
+    return False
+  if stat.S_ISLNK(st.st_mode):
+    return False
+  if strategy == STRATEGY_HARDLINK:
+    return os.path.samestat(st, target_st)
+  if stat.S_ISDIR(st.st_mode) != stat.S_ISDIR(target_st.st_mode):
+    return False
+  if not stat.S_ISDIR(st.st_mode) and st.st_size != target_st.st_size:
+    return False
+  return sameContents(path, target, hashes)
+
+def undoAction(action, store = None, record = None):
+  """Puts back what was in place before action was applied.
+
+  It works on actions that were only partially applied too, by looking at
+  what is left in the filesystem. Pruned backups can't be restored.
+
+  @param record: The BackupStore record of the backup, if known.
+  @raise OSError: If it can't be undone.
+  """
+  path = action["path"]
+  if action["action"] == ACTION_MKDIR:
+    for directory in action.get("created", [path]):
+      try:
+        os.rmdir(directory)
+      except FileNotFoundError:
+        pass
+      except OSError:
+        # Something else was put in it.
+        break
+    return
+  if action["action"] not in [ACTION_LINK, ACTION_BACKUP_LINK]:
+    return
+
+  backup = action.get("backup")
+  if isInstalled(path, action["target"],
+      action.get("strategy", STRATEGY_SYMLINK)):
+    removePath(path)
+  if os.path.lexists(path):
+    # The original element is still there. A backup made with a second link
+    # to it is not needed.
+    if backup is not None and not backup.startswith(STORE_PREFIX) and \
+        os.path.lexists(backup) and \
+        os.path.samestat(os.lstat(path), os.lstat(backup)):
+      os.remove(backup)
+    return
+  if action["action"] == ACTION_LINK:
+    return
+  if backup is None:
+    backup = action.get("current_backup")
+  if backup is None:
+    return
+  if backup.startswith(STORE_PREFIX):
+    if record is None and store is not None:
+      record = store.latest(path)
+    if record is None:
+      raise OSError(errno.ENOENT, "No backup in the store", path)
+    store.restore(record, path)
+  elif action.get("backup") is not None:
+    os.rename(backup, path)
+  elif os.path.isdir(backup) and not os.path.islink(backup):
+    # The element was identical to its most recent backup and was removed.
+    copyTree(backup, path)
+  elif os.path.islink(backup):
+    os.symlink(os.readlink(backup), path)
+  else:
+    cloneFile(backup, path)
+
+class Journal:
+  """Write-ahead log of the changes made while applying a plan.
+
+  Every action is written before the filesystem is touched, and marked when
+  it's done, so the last run can be rolled back with --rollback even if it
+  was interrupted. A Journal without a file doesn't record anything.
+  """
+
+  def __init__(self, filename = None):
+    self.filename = filename
+    self.stream = None
+    self.lock = threading.Lock()
+    self.count = 0
+
+  def start(self):
+    """Starts a new journal, replacing the one of the last run."""
+    if self.filename is not None:
+      os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+      self.stream = open(self.filename, "w")
+    return self
+
+  def write(self, **fields):
+    if self.stream is None:
+      return
+    with self.lock:
+      self.stream.write(json.dumps(fields, sort_keys = True) + "\n")
+      self.stream.flush()
+
+  def begin(self, action, **fields):
+    """Records that action is about to be applied.
+
+    @param fields: Added to the action, for undoAction().
+    @return: The id of the entry, for done().
+    """
+    with self.lock:
+      self.count += 1
+      entry = self.count
+    self.write(id = entry, event = "begin", action = dict(action, **fields))
+    return entry
+
+  def done(self, entry, status = "ok", **fields):
+    """Records the outcome of an entry: "ok", "error", "undone" or a step."""
+    self.write(id = entry, event = status, **fields)
+
+  def close(self):
+    if self.stream is not None:
+      self.stream.flush()
+      os.fsync(self.stream.fileno())
+      self.stream.close()
+      self.stream = None
+
+  @staticmethod
+  def read(filename):
+    """Returns the entries of a journal, in the order they were started.
+
+    Every entry is a dict with the "action", its last "status" and the
+    "record" of its backup in the store, if any.
+    """
+    entries = {}
+    with open(filename, "r") as stream:
+      for line in stream:
+        try:
+          event = json.loads(line)
+        except ValueError:
+          # The last line may be incomplete if the run was interrupted.
+          break
+        if event["event"] == "begin":
+          entries[event["id"]] = {"action": event["action"],
+            "status": "started", "record": None}
+        elif event["id"] in entries:
+          entries[event["id"]]["status"] = event["event"]
+          if "record" in event:
+            entries[event["id"]]["record"] = event["record"]
+    return [entries[key] for key in sorted(entries)]
+
+def rollback(context, journal_file, store = None, state = None):
+  """Undoes the last run recorded in journal_file, newest changes first.
+
+  The journal is renamed when it's done, so it can't be rolled back twice.
+
+  @return: The number of actions that could not be undone.
+  """
+  try:
+    entries = Journal.read(journal_file)
+  except OSError:
+    context.message("Error: There is no run to roll back in " + journal_file,
+      error = True)
+    return 1
+  if not entries:
+    context.message("Error: Nothing to roll back in " + journal_file,
+      error = True)
+    return 1
+  failed = 0
+  for entry in reversed(entries):
+    action = entry["action"]
+    if entry["status"] == "undone":
+      continue
+    try:
+      undoAction(action, store, entry["record"])
+      if action["action"] != ACTION_MKDIR:
+        context.message("Rolled back: " + action["path"])
+      if state is not None:
+        state.modules.pop(action["module"], None)
+    except OSError as e:
+      context.message("Error: Could not roll back " + action["path"] + ": " +
+        str(e), error = True)
+      failed += 1
+    for old_backup in action.get("prune", []):
+      context.message("Warning: " + old_backup + " was removed and can't be " +
+        "restored.", error = True)
+  os.replace(journal_file, journal_file + ".rolled-back")
+  return failed
+
+def getFullPath(context, basepath, middle, filename, meta_dir, module_name,
+    plan, path = None):
+  if path is not None:
+    # The path was given in the answers file.
+    path = expandPath(path)
+  elif not os.path.normpath(basepath).strip():
     # If the basepath is empty we should always prompt.
-    path = promptPath(filename, "")
+    path = promptPath(context, filename, "")
   elif not middle.strip():
     if not basepath.strip():
       # We have no information, just prompt.
-      path = promptPath(filename, "")
+      path = promptPath(context, filename, "")
     else:
       # We have a basepath and no middle.
       path = os.path.join(basepath, filename)
@@ -353,62 +3205,62 @@ def getFullPath(basepath, middle, filename, meta_dir):
       # We actually have 3 parts.
       path = os.path.join(basepath, middle, filename)
 
+  if path and plan.target is not None:
+    path = plan.target.path(path)
+
   path_valid = False
   while not path_valid:
     path_valid = True
 
     # Skip this element?
-    if path is "" or path is None:
+    if path == "" or path is None:
       return None
 
     # Whoa, lots of ifs. At this point we have a path. Let's make sure it
     # exists, otherwise, prompt. We actually don't need it to exist,
     # we just need the base dir to exist.
     parent_dir, _ = os.path.split(path)
-    if not os.path.isdir(parent_dir):
-      printWithDelay(" - Directory doesn't exist: " + parent_dir, error = True)
-      create = promptYesNo(" - Would you like to create it?")
+    if not plan.resolver.isdir(parent_dir) and \
+        os.path.abspath(parent_dir) not in plan.created_dirs:
+      context.message(" - Directory doesn't exist: " + parent_dir, error = True)
+      create = promptAnswer(context, plan, module_name, "mkdir",
+        " - Would you like to create it?")
       if create:
-        try:
-          if not args.dry_run:
-            os.makedirs(parent_dir, exist_ok=True)
-          printWithDelay(" - Created directory: " + parent_dir)
-          return path
-        except OSError:
-          if not os.path.isdir(parent_dir):
-            printWithDelay(" - Failed to create directory: " + parent_dir,
-              error = True)
-            printWithDelay(" - Do we have the right permissions?", error = True)
-            path_valid = False
+        # The directory is created when the plan is applied.
+        plan.add(ACTION_MKDIR, module_name, path = os.path.abspath(parent_dir))
+        return path
+      elif plan.answers.get(module_name, "mkdir") is False:
+        return None
       else:
         path_valid = False
 
     # Make sure the path provided is not in the metaconfig folder.
     # The only valid case for this is if it's a symlink on the leaf, meaning
     # its a symlink createad by this script or something similar.
-    if not os.path.islink(path):
-      real_path = os.path.realpath(path)
-      real_meta_dir = os.path.realpath(meta_dir)
+    mode = plan.resolver.mode(path)
+    if mode is None or not stat.S_ISLNK(mode):
+      real_path = plan.resolver.realpath(path)
+      real_meta_dir = plan.resolver.realdir(meta_dir)
       length = len(real_meta_dir)
       if len(real_path) >= length and real_path[:length] == meta_dir:
-        printWithDelay("Error: The path provided is inside the metaconfig " +
+        context.message("Error: The path provided is inside the metaconfig " +
           "folder.", error = True)
-        printWithDelay("Please provide a path to the local file you want " +
+        context.message("Please provide a path to the local file you want " +
           "replaced.", error = True)
         path_valid = False
 
     if not path_valid:
-      path = promptPath(filename, "")
+      path = promptPath(context, filename, "")
 
   return path
 
-def promptPath(filename, defaultPath):
-  global args
-  if args.non_interactive:
-    printWithDelay("No path provided. Cannot prompt in non-interactive mode.",
+def promptPath(context, filename, defaultPath):
+  if context.args.non_interactive:
+    context.message("No path provided. Cannot prompt in non-interactive mode.",
       error = True)
     return None
 
+  import readline
   readline.set_completer_delims(' \t\n;')
   readline.parse_and_bind("tab: complete")
   readline.set_completer(promptPathCompleter)
@@ -417,20 +3269,20 @@ def promptPath(filename, defaultPath):
   path = None
   while True:
     if filename is None:
-      printWithDelay(" - Provide the base path (local) for the all the files " +
-        "in this module.")
-      printWithDelay(" - You can press tab to autocomplete. " +
+      context.message(" - Provide the base path (local) for the all the " +
+        "files in this module.")
+      context.message(" - You can press tab to autocomplete. " +
         "Leave empty to enter the location of each link individually.")
-      path = input(" >>> ")
+      path = context.output.prompt(" >>> ")
     else:
-      printWithDelay(" - Provide a path for the local " + filename +
+      context.message(" - Provide a path for the local " + filename +
         " in this computer.")
-      printWithDelay(" - You can press tab to autocomplete. " +
+      context.message(" - You can press tab to autocomplete. " +
         "Leave empty to skip this file.")
-      path = input(" - " + filename + " >>> ")
+      path = context.output.prompt(" - " + filename + " >>> ")
 
     # If we get an empty string back, just return, indicating to skip this file.
-    if path.strip() is "":
+    if path.strip() == "":
       return None
 
     path = expandPath(path)
@@ -439,7 +3291,7 @@ def promptPath(filename, defaultPath):
     if filename is not None:
       join = os.path.join(path, filename)
       if os.path.isdir(path) and os.path.lexists(join):
-        if promptYesNo("Install at " + join + " ?"):
+        if promptYesNo(context, "Install at " + join + " ?"):
           return join
 
     # We get something that exists
@@ -447,7 +3299,7 @@ def promptPath(filename, defaultPath):
       if filename is None:
         # This means we are trying to get the location for the whole module
         return path
-      if promptYesNo("Install at " + path + " ?"):
+      if promptYesNo(context, "Install at " + path + " ?"):
         return path
       else:
         continue
@@ -456,17 +3308,28 @@ def promptPath(filename, defaultPath):
     # the path to a new file, which is fine.
     base, _ = os.path.split(path)
     if os.path.lexists(base) and os.path.isdir(base):
-      if promptYesNo("Install at " + path + " ?"):
+      if promptYesNo(context, "Install at " + path + " ?"):
         return path
       else:
         continue
 
-    printWithDelay("Invalid path. Please try again.", error = True)
+    context.message("Invalid path. Please try again.", error = True)
 
   raise ValueError("We should never make it here.")
   return None
 
-def promptYesNo(question, default="yes"):
+def promptAnswer(context, plan, module_name, key, question):
+  """Returns the answer to question from the answers file, or asks the user.
+
+  @param key: The field of the answers file with the answer to question.
+  """
+  answer = plan.answers.get(module_name, key)
+  if answer is None:
+    return promptYesNo(context, question)
+  context.message(question + (" yes" if answer else " no") + " (answers file)")
+  return answer
+
+def promptYesNo(context, question, default="yes"):
   """Ask a yes/no question via input() and return their answer.
 
   "question" is a string that is presented to the user.
@@ -477,11 +3340,11 @@ def promptYesNo(question, default="yes"):
   The "answer" return value is one of "yes" or "no".
   Taken from: http://code.activestate.com/recipes/577058/
   """
-  global args
-  if args.non_interactive:
+  if context.args.non_interactive:
     return True
 
   # Reset to default values.
+  import readline
   readline.set_completer(None)
   readline.set_startup_hook(None)
 
@@ -497,92 +3360,756 @@ def promptYesNo(question, default="yes"):
     raise ValueError("Invalid default answer: '%s'" % default)
 
   while True:
-    printWithDelay(question + prompt, end="")
-    choice = input().lower()
+    choice = context.output.prompt(question + prompt).lower()
     if default is not None and not choice.strip():
       return valid[default]
     elif choice in valid:
       return valid[choice]
     else:
-      printWithDelay("Please respond with 'yes' or 'no' (or 'y' or 'n').")
+      context.message("Please respond with 'yes' or 'no' (or 'y' or 'n').")
 
 
-def compareDirs(dir1, dir2):
-  """
-  Compare two directories recursively. Files in each directory are
-  assumed to be equal if their names and contents are equal.
+def compareDirs(dir1, dir2, jobs = 1):
+  """Compares two directory trees.
+
+  The trees are walked one directory at a time, without recursion, and the
+  comparison stops at the first difference. Entries are the same if they
+  have the same names and types, symlinks if they point to the same place
+  and files if they have the same size and contents. Contents are only read
+  when everything else matched, in up to jobs files at the same time.
 
   @param dir1: First directory path
   @param dir2: Second directory path
+  @param jobs: Number of files to compare at the same time.
 
   @return: True if the directory trees are the same and
       there were no errors while accessing the directories or files,
       False otherwise.
-  Taken from: http://stackoverflow.com/a/6681395/131319
   """
-  dirs_cmp = filecmp.dircmp(dir1, dir2)
-  if len(dirs_cmp.left_only)>0 or len(dirs_cmp.right_only)>0 or \
-    len(dirs_cmp.funny_files)>0:
+  def scan(path):
+    with os.scandir(path) as it:
+      return {entry.name: entry for entry in it}
+
+  pool = None
+  pending = set()
+  stack = [(dir1, dir2)]
+  try:
+    while stack:
+      left, right = stack.pop()
+      try:
+        entries1 = scan(left)
+        entries2 = scan(right)
+      except OSError:
+        return False
+      if entries1.keys() != entries2.keys():
+        return False
+      subdirs = []
+      for name, entry1 in entries1.items():
+        entry2 = entries2[name]
+        try:
+          st1 = entry1.stat(follow_symlinks = False)
+          st2 = entry2.stat(follow_symlinks = False)
+          if stat.S_IFMT(st1.st_mode) != stat.S_IFMT(st2.st_mode):
+            return False
+          if stat.S_ISDIR(st1.st_mode):
+            subdirs.append((entry1.path, entry2.path))
+            continue
+          if stat.S_ISLNK(st1.st_mode):
+            if os.readlink(entry1.path) != os.readlink(entry2.path):
+              return False
+            continue
+        except OSError:
+          return False
+        # Other special files, like sockets, have no contents to compare.
+        if not stat.S_ISREG(st1.st_mode) or os.path.samestat(st1, st2):
+          continue
+        if st1.st_size != st2.st_size:
+          return False
+        if st1.st_size == 0:
+          continue
+        if jobs <= 1:
+          if not compareFiles(entry1.path, entry2.path):
+            return False
+          continue
+        if pool is None:
+          import concurrent.futures
+          pool = concurrent.futures.ThreadPoolExecutor(max_workers = jobs)
+        pending.add(pool.submit(compareFiles, entry1.path, entry2.path))
+        # Don't get too far ahead of the comparisons.
+        if len(pending) >= jobs * 4:
+          done, pending = concurrent.futures.wait(pending,
+            return_when = concurrent.futures.FIRST_COMPLETED)
+          if not all(future.result() for future in done):
+            return False
+      stack.extend(reversed(subdirs))
+    return all(future.result() for future in pending)
+  finally:
+    if pool is not None:
+      for future in pending:
+        future.cancel()
+      pool.shutdown()
+
+def compareFiles(path1, path2):
+  """Checks if two files of the same size have the same contents.
+
+  @return: False if they are different or can't be read.
+  """
+  try:
+    with open(path1, "rb", buffering = 0) as stream1, \
+        open(path2, "rb", buffering = 0) as stream2:
+      while True:
+        block = stream1.read(COMPARE_BLOCK_SIZE)
+        if block != stream2.read(COMPARE_BLOCK_SIZE):
+          return False
+        if not block:
+          return True
+  except OSError:
     return False
-  (_, mismatch, errors) =  filecmp.cmpfiles(
-    dir1, dir2, dirs_cmp.common_files, shallow=False)
-  if len(mismatch)>0 or len(errors)>0:
+
+# Size of the reads when comparing files.
+COMPARE_BLOCK_SIZE = 1024 * 1024
+
+class HashCache:
+  """Content digests of files and directories, saved between runs.
+
+  The digest of a file is remembered together with its size, modification
+  time and inode, and it is only read again when one of those changed. The
+  digest of a directory is computed from the names, types and digests of its
+  entries (like a Merkle tree), so an unchanged tree is recognized with stat
+  calls only.
+  """
+
+  VERSION = 1
+  # Files modified this recently may still change without their mtime
+  # changing, so their digest is not remembered.
+  RACY_SECONDS = 2
+  BLOCK_SIZE = 1024 * 1024
+
+  def __init__(self, filename = None):
+    self.filename = filename
+    # Maps a path to [size, mtime_ns, inode, digest].
+    self.entries = {}
+    self.used = {}
+
+  def load(self):
+    try:
+      with open(self.filename, "r") as stream:
+        data = json.load(stream)
+      if data.get("version") == self.VERSION:
+        self.entries = data["entries"]
+    except (OSError, ValueError, KeyError, AttributeError):
+      self.entries = {}
+    return self
+
+  def save(self):
+    """Saves the entries used during this run."""
+    os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+    temp = self.filename + ".tmp"
+    with open(temp, "w") as stream:
+      json.dump({"version": self.VERSION, "entries": self.used}, stream)
+    os.replace(temp, self.filename)
+
+  def move(self, old_path, new_path):
+    """Carries the entries under old_path over to new_path.
+
+    Called when old_path is about to be renamed. Entries are still checked
+    against the size, mtime and inode, so this is safe even if the rename
+    never happens.
+    """
+    prefix = old_path + os.sep
+    for table in [self.entries, self.used]:
+      for path in [p for p in table if p == old_path or p.startswith(prefix)]:
+        table[new_path + path[len(old_path):]] = table[path]
+
+  @staticmethod
+  def linkDigest(link_target):
+    return hashlib.sha256(b"l" + os.fsencode(link_target)).hexdigest()
+
+  @staticmethod
+  def treeDigest(entries):
+    """Digest of a directory given a sorted list of (name, digest) pairs."""
+    h = hashlib.sha256(b"d")
+    for name, digest in entries:
+      h.update(os.fsencode(name) + b"\0")
+      h.update(digest.encode() + b"\0")
+    return h.hexdigest()
+
+  def digest(self, path):
+    """Returns the hex digest of a file, symlink or directory tree.
+
+    Directories are walked without recursion, and their digest is computed
+    once the digests of all their entries are known.
+    """
+    digests = {}
+    listings = {}
+    pending = [(path, False)]
+    while pending:
+      current, listed = pending.pop()
+      if listed:
+        names = listings.pop(current)
+        digests[current] = self.treeDigest([(name,
+          digests.pop(os.path.join(current, name))) for name in names])
+        continue
+      st = os.lstat(current)
+      if stat.S_ISDIR(st.st_mode):
+        with os.scandir(current) as it:
+          names = sorted(entry.name for entry in it)
+        listings[current] = names
+        pending.append((current, True))
+        pending.extend((os.path.join(current, name), False)
+          for name in reversed(names))
+      else:
+        digests[current] = self.fileDigest(current, st)
+    return digests[path]
+
+  def fileDigest(self, path, st):
+    """Returns the hex digest of anything but a directory."""
+    if stat.S_ISLNK(st.st_mode):
+      return self.linkDigest(os.readlink(path))
+    if not stat.S_ISREG(st.st_mode):
+      return hashlib.sha256(b"o").hexdigest()
+
+    key = [st.st_size, st.st_mtime_ns, st.st_ino]
+    entry = self.entries.get(path)
+    if entry is not None and entry[:3] == key:
+      self.used[path] = entry
+      return entry[3]
+    h = hashlib.sha256(b"f")
+    with open(path, "rb") as stream:
+      for block in iter(lambda: stream.read(self.BLOCK_SIZE), b""):
+        h.update(block)
+    digest = h.hexdigest()
+    if time.time() - st.st_mtime > self.RACY_SECONDS:
+      self.entries[path] = self.used[path] = key + [digest]
+    return digest
+
+# Backups kept in the BackupStore are named with this prefix in plans.
+STORE_PREFIX = "store:"
+
+class BackupStore:
+  """Backups kept by content in a single directory, instead of as .bakN.
+
+  Files are stored once per content in objects/<digest>, directories are
+  described by a listing in trees/<digest>.json and manifest.json maps every
+  original path to its backups, oldest first. Files are hard linked into the
+  store, so creating a backup copies nothing when the store is on the same
+  filesystem, and the original stays in place until it's replaced. Restored
+  files are reflinked from the store when the filesystem supports
+  it, and copied otherwise.
+  """
+
+  VERSION = 1
+
+  def __init__(self, directory, hashes, keep = None):
+    self.directory = directory
+    self.hashes = hashes
+    # Number of backups to keep for each path. None keeps all of them.
+    self.keep = keep
+    self.backups = {}
+    # Objects and trees of backups that failed, removed by finish().
+    self.orphans = []
+    self.lock = threading.Lock()
+
+  def objectPath(self, digest):
+    return os.path.join(self.directory, "objects", digest)
+
+  def treePath(self, digest):
+    return os.path.join(self.directory, "trees", digest + ".json")
+
+  def load(self):
+    try:
+      with open(os.path.join(self.directory, "manifest.json"), "r") as stream:
+        data = json.load(stream)
+      if data.get("version") == self.VERSION:
+        self.backups = data["backups"]
+    except (OSError, ValueError, KeyError, AttributeError):
+      self.backups = {}
+    return self
+
+  def save(self):
+    filename = os.path.join(self.directory, "manifest.json")
+    with open(filename + ".tmp", "w") as stream:
+      json.dump({"version": self.VERSION, "backups": self.backups}, stream,
+        indent = 1)
+    os.replace(filename + ".tmp", filename)
+
+  def latest(self, path):
+    """Returns the most recent backup record of path, or None."""
+    records = self.backups.get(os.path.abspath(path))
+    return records[-1] if records else None
+
+  def add(self, path):
+    """Copies path into the store and records it as its latest backup.
+
+    path is left untouched. If anything fails, nothing is recorded and
+    whatever was added to the store is removed by finish(). Backups can be
+    added from several threads at the same time, so nothing is removed from
+    the store until then.
+
+    @return: The new backup record.
+    """
+    path = os.path.abspath(path)
+    for name in ["objects", "trees"]:
+      os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+    staged = []
+    try:
+      record = self.ingest(path, staged)
+      record["time"] = time.time()
+      with self.lock:
+        records = self.backups.setdefault(path, [])
+        records.append(record)
+        try:
+          self.save()
+        except OSError:
+          records.pop()
+          raise
+    except OSError:
+      with self.lock:
+        self.orphans += staged
+      raise
+    return record
+
+  def finish(self):
+    """Prunes old backups and removes what no backup refers to anymore.
+
+    Called once no backups are being added, like after applying a plan.
+    """
+    with self.lock:
+      pruned = False
+      if self.keep is not None:
+        for records in self.backups.values():
+          if len(records) > self.keep:
+            del records[:len(records) - self.keep]
+            pruned = True
+      if pruned:
+        self.save()
+      if pruned or self.orphans:
+        self.collect()
+      self.orphans = []
+
+  def ingest(self, path, staged):
+    """Adds a file, symlink or directory tree to the store.
+
+    Directories are walked without recursion, and finished once all their
+    entries are in the store.
+
+    @param staged: Objects and trees added to the store are appended to it,
+      so they can be removed if the backup fails.
+    @return: The backup record of path.
+    """
+    records = {}
+    listings = {}
+    pending = [(path, False)]
+    while pending:
+      current, listed = pending.pop()
+      if listed:
+        st, names = listings.pop(current)
+        entries = [[name, records.pop(os.path.join(current, name))]
+          for name in names]
+        records[current] = self.addTree(entries, st, staged)
+        continue
+      st = os.lstat(current)
+      if stat.S_ISDIR(st.st_mode):
+        with os.scandir(current) as it:
+          names = sorted(entry.name for entry in it)
+        listings[current] = (st, names)
+        pending.append((current, True))
+        pending.extend((os.path.join(current, name), False)
+          for name in reversed(names))
+      else:
+        records[current] = self.addFile(current, st, staged)
+    return records[path]
+
+  def addTree(self, entries, st, staged):
+    """Stores the listing of a directory given the records of its entries."""
+    digest = HashCache.treeDigest([(name, child["digest"])
+      for name, child in entries])
+    tree = self.treePath(digest)
+    if not os.path.exists(tree):
+      with open(tree + ".tmp", "w") as stream:
+        json.dump(entries, stream)
+      os.replace(tree + ".tmp", tree)
+      staged.append(tree)
+    return {"kind": "dir", "digest": digest, "mode": stat.S_IMODE(st.st_mode)}
+
+  def addFile(self, path, st, staged):
+    """Stores anything but a directory."""
+    if stat.S_ISLNK(st.st_mode):
+      target = os.readlink(path)
+      return {"kind": "link", "target": target,
+        "digest": HashCache.linkDigest(target)}
+    if not stat.S_ISREG(st.st_mode):
+      # Sockets, pipes and devices have no contents worth keeping.
+      return {"kind": "other", "digest": hashlib.sha256(b"o").hexdigest()}
+
+    digest = self.hashes.digest(path)
+    stored = self.objectPath(digest)
+    if not os.path.exists(stored):
+      try:
+        os.link(path, stored)
+      except OSError:
+        # Probably a different filesystem.
+        cloneFile(path, stored + ".tmp")
+        os.chmod(stored + ".tmp", 0o444)
+        os.replace(stored + ".tmp", stored)
+      staged.append(stored)
+    return {"kind": "file", "digest": digest, "mode": stat.S_IMODE(st.st_mode)}
+
+  def restore(self, record, path):
+    """Recreates the element described by a backup record at path.
+
+    Directories are recreated without recursion, and get their mode once all
+    their entries are in place.
+    """
+    pending = [(record, path, False)]
+    while pending:
+      record, path, filled = pending.pop()
+      kind = record["kind"]
+      if filled:
+        os.chmod(path, record["mode"])
+      elif kind == "link":
+        os.symlink(record["target"], path)
+      elif kind == "file":
+        cloneFile(self.objectPath(record["digest"]), path)
+        os.chmod(path, record["mode"])
+      elif kind == "dir":
+        os.mkdir(path)
+        with open(self.treePath(record["digest"]), "r") as stream:
+          entries = json.load(stream)
+        pending.append((record, path, True))
+        pending.extend((child, os.path.join(path, name), False)
+          for name, child in reversed(entries))
+
+  def collect(self):
+    """Removes the objects and trees no backup refers to anymore."""
+    objects, trees = set(), set()
+    pending = [record for records in self.backups.values()
+      for record in records]
+    while pending:
+      record = pending.pop()
+      if record["kind"] == "file":
+        objects.add(record["digest"])
+      elif record["kind"] == "dir" and record["digest"] not in trees:
+        trees.add(record["digest"])
+        try:
+          with open(self.treePath(record["digest"]), "r") as stream:
+            pending.extend(child for _, child in json.load(stream))
+        except (OSError, ValueError):
+          pass
+    for name, keep in [("objects", objects), ("trees", trees)]:
+      directory = os.path.join(self.directory, name)
+      for entry in os.listdir(directory):
+        digest = entry[:-len(".json")] if name == "trees" else entry
+        if digest not in keep:
+          os.remove(os.path.join(directory, entry))
+
+def restoreBackups(context, paths, store = None, state = None):
+  """Puts the most recent backup of every path back in place.
+
+  The backup comes from the store if it has one, and from the newest .bakN
+  otherwise. Only symlinks (usually the ones installed by this script) and
+  hard links or copies the state says were installed, and are still the
+  same, are replaced. Anything else at path is left alone.
+
+  @param state: The State of the last run, to find the links that are not
+    symlinks.
+
+  @return: The number of paths that could not be restored.
+  """
+  installed = {}
+  if state is not None:
+    installed = {path: (target, strategy)
+      for _, path, target, strategy in state.links()
+      if strategy != STRATEGY_SYMLINK}
+  failed = 0
+  for path in paths:
+    path = os.path.abspath(expandPath(path))
+    record = store.latest(path) if store is not None else None
+    current, _ = getBackupPaths(path)
+    if record is None and current is None:
+      context.message("Error: There are no backups of " + path, error = True)
+      failed += 1
+      continue
+    if os.path.lexists(path) and not os.path.islink(path) and \
+        not (path in installed and isInstalled(path, *installed[path])):
+      context.message("Error: " + path + " exists and is not a symlink or " +
+        "a link installed by this script. Skipping.", error = True)
+      failed += 1
+      continue
+    try:
+      if os.path.lexists(path):
+        removePath(path)
+      if record is not None:
+        store.restore(record, path)
+        context.message("Restored " + path + " from " + STORE_PREFIX +
+          record["digest"])
+      else:
+        shutil.move(current, path)
+        context.message("Restored " + path + " from " + current)
+    except OSError as e:
+      context.message("Error: Could not restore " + path + ": " + str(e),
+        error = True)
+      failed += 1
+  return failed
+
+def copyFile(source, destination):
+  """Copies a file and its permissions, letting the kernel do the work.
+
+  copy_file_range() copies without going through this process, and lets
+  filesystems like NFS copy on the server. shutil falls back to sendfile()
+  and then to reading and writing.
+  """
+  if hasattr(os, "copy_file_range"):
+    try:
+      with open(source, "rb") as src, open(destination, "wb") as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+          copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+          if copied == 0:
+            break
+          remaining -= copied
+      shutil.copymode(source, destination)
+      return destination
+    except OSError as e:
+      if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+          errno.EOPNOTSUPP, errno.EBADF]:
+        raise
+  shutil.copyfile(source, destination)
+  shutil.copymode(source, destination)
+  return destination
+
+def cloneFile(source, destination):
+  """Copies a file, sharing its blocks (reflink) if the filesystem can."""
+  if sys.platform.startswith("linux"):
+    FICLONE = 0x40049409
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+      try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(source, destination)
+        return
+      except OSError:
+        pass
+  shutil.copy2(source, destination)
+
+def sameContents(path1, path2, hashes = None, jobs = 1):
+  """Checks if two files or directories have the same contents.
+
+  Directories are assumed to be equal if their names and contents are the
+  same (recursively).
+
+  @param hashes: A HashCache to compare digests with. If None, the contents
+    are compared directly.
+  @param jobs: Number of files to compare at the same time in directories.
+  """
+  try:
+    if hashes is not None:
+      return hashes.digest(path1) == hashes.digest(path2)
+    if os.path.isdir(path1) and os.path.isdir(path2):
+      return compareDirs(path1, path2, jobs)
+    if os.path.isfile(path1) and os.path.isfile(path2):
+      import filecmp
+      return filecmp.cmp(path1, path2)
+  except (OSError, RecursionError):
+    # Treated as different, so a new backup is made to be safe.
     return False
-  for common_dir in dirs_cmp.common_dirs:
-    new_dir1 = os.path.join(dir1, common_dir)
-    new_dir2 = os.path.join(dir2, common_dir)
-    if not compareDirs(new_dir1, new_dir2):
-      return False
-  return True
+  return False
+
+def copyTree(source, destination, copy = shutil.copy2):
+  """Copies a directory tree like shutil.copytree(), without recursion.
+
+  Symlinks are copied as symlinks, and directories get the mode and times of
+  the original once all their entries are copied.
+
+  @param copy: Function used to copy every file.
+  """
+  pending = [(source, destination, False)]
+  while pending:
+    source, destination, filled = pending.pop()
+    if filled:
+      shutil.copystat(source, destination)
+      continue
+    os.mkdir(destination)
+    pending.append((source, destination, True))
+    with os.scandir(source) as it:
+      for entry in it:
+        path = os.path.join(destination, entry.name)
+        if entry.is_symlink():
+          os.symlink(os.readlink(entry.path), path)
+        elif entry.is_dir():
+          pending.append((entry.path, path, False))
+        else:
+          copy(entry.path, path)
+
+def removePath(path):
+  """Removes a file, symlink or directory tree, without recursion."""
+  pending = [(path, False)]
+  while pending:
+    current, emptied = pending.pop()
+    if emptied:
+      os.rmdir(current)
+    elif os.path.isdir(current) and not os.path.islink(current):
+      pending.append((current, True))
+      with os.scandir(current) as it:
+        pending.extend((entry.path, False) for entry in it)
+    else:
+      os.remove(current)
 
 def expandPath(path):
   return os.path.expandvars(os.path.expanduser(path))
 
-def getBackupPaths(path):
+class Resolver:
+  """Memoizes the path lookups made while planning.
+
+  The links of a module share a few directories, so expanding, resolving and
+  checking those happens once per directory instead of once per link. What
+  is remembered is only valid while nothing else changes the filesystem, and
+  created() has to be called for every directory this script creates.
+  """
+
+  def __init__(self):
+    self.expanded = {}
+    self.dirs = {}
+    self.real_dirs = {}
+    self.modes = {}
+
+  def expand(self, path):
+    """Memoized expandPath()."""
+    try:
+      return self.expanded[path]
+    except KeyError:
+      expanded = self.expanded[path] = expandPath(path)
+      return expanded
+
+  def isdir(self, path):
+    """Memoized os.path.isdir()."""
+    try:
+      return self.dirs[path]
+    except KeyError:
+      result = self.dirs[path] = os.path.isdir(path)
+      return result
+
+  def mode(self, path):
+    """Memoized st_mode of os.lstat(), None if path doesn't exist."""
+    try:
+      return self.modes[path]
+    except KeyError:
+      try:
+        mode = os.lstat(path).st_mode
+      except OSError:
+        mode = None
+      self.modes[path] = mode
+      return mode
+
+  def realdir(self, path):
+    """Memoized os.path.realpath(), for directories."""
+    try:
+      return self.real_dirs[path]
+    except KeyError:
+      real = self.real_dirs[path] = os.path.realpath(path)
+      return real
+
+  def realpath(self, path):
+    """os.path.realpath(), resolving the parent directory only once.
+
+    Unless the last component is a symlink, the real path is the real path
+    of the parent followed by the name.
+    """
+    path = os.path.abspath(path)
+    mode = self.mode(path)
+    if mode is not None and stat.S_ISLNK(mode):
+      return os.path.realpath(path)
+    parent, name = os.path.split(path)
+    return os.path.join(self.realdir(parent), name)
+
+  def created(self, path):
+    """Forgets what was known about a directory that was just created."""
+    path = os.path.abspath(path)
+    while True:
+      for cache in [self.dirs, self.real_dirs, self.modes]:
+        cache.pop(path, None)
+      parent = os.path.dirname(path)
+      if parent == path:
+        break
+      path = parent
+
+class BackupIndex:
+  """Keeps track of the existing backups, one directory at a time.
+
+  The first time a directory is needed it is listed once and every ".bakN"
+  entry in it is remembered, so finding the backups of a path never needs
+  more than one listing per directory during a run.
+  """
+
+  BACKUP_PATTERN = re.compile(r"^(.*)\.bak([0-9]+)$")
+
+  def __init__(self):
+    # Maps a directory to {name: sorted list of backup numbers}.
+    self.dirs = {}
+
+  def generations(self, path):
+    """Returns the sorted list of backup numbers of path."""
+    parent, name = os.path.split(path)
+    if parent not in self.dirs:
+      backups = {}
+      try:
+        names = os.listdir(parent or os.curdir)
+      except OSError:
+        names = []
+      for entry in names:
+        match = self.BACKUP_PATTERN.match(entry)
+        if match:
+          backups.setdefault(match.group(1), []).append(int(match.group(2)))
+      for numbers in backups.values():
+        numbers.sort()
+      self.dirs[parent] = backups
+    return self.dirs[parent].setdefault(name, [])
+
+  def add(self, path, number):
+    """Remembers that a backup of path with the given number will exist."""
+    numbers = self.generations(path)
+    if number not in numbers:
+      numbers.append(number)
+      numbers.sort()
+
+  def prune(self, path, keep):
+    """Forgets all but the most recent keep backups of path.
+
+    @return: The list of the backup paths that should be removed.
+    """
+    numbers = self.generations(path)
+    if len(numbers) <= keep:
+      return []
+    old = numbers[:len(numbers) - keep]
+    del numbers[:len(numbers) - keep]
+    return [path + ".bak" + str(n) for n in old]
+
+def getBackupPaths(path, index = None):
   """Determines the current and next backup names for the specified path.
 
+  Backups are numbered in order, the next backup is always numbered after the
+  most recent one, even if older ones were removed.
+
   @param path: The path to the file or folder to be checked.
+  @param index: The BackupIndex to use. If None, the directory is listed.
 
   @return: A string consisting of path +  ".bak" + n where n is the biggest
-    (most recent) backup.
+    (most recent) backup, or None if there are no backups.
 
   @return: A string consisting of path +  ".bak" + n where n is the next
      available (non-existent) backup path.
   """
   path = expandPath(os.path.normpath(path))
-  i = 0
-  current = None
-  next = None
-  while True:
-    i += 1
-    next = path + ".bak" + str(i)
-    if not os.path.lexists(next):
-      return current, next
-    current = next
-
-def isTempFile(filename):
-  temp = ["*.*~", "*.swp", ".DS_Store"]
-  for pattern in temp:
-    if fnmatch.fnmatch(filename, pattern):
-      return True
-  return False
+  if index is None:
+    index = BackupIndex()
+  numbers = index.generations(path)
+  if not numbers:
+    return None, path + ".bak1"
+  return path + ".bak" + str(numbers[-1]), path + ".bak" + str(numbers[-1] + 1)
 
 def promptPathCompleter(text, state):
   text = expandPath(text)
+  import glob
   return (glob.glob(text + '*')+[None])[state]
 
-def printWithDelay(text, end = "\n", error = False, delay = 0.003):
-  global args
-  if error:
-    print(TextColors.ERROR, end='')
-  if args.non_interactive:
-    print(text, end='')
-  else:
-    for l in text:
-      sys.stdout.write(l)
-      sys.stdout.flush()
-      time.sleep(delay)
-  print(TextColors.END, end=end)
-
 if __name__ == "__main__":
-    main(sys.argv[1:])
+  sys.exit(main(sys.argv[1:]))
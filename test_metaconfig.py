@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# Tests for metaconfig.py.
+#
+# Every test gets its own repository, home directory and state directory in
+# a temporary directory. Command line runs use a copy of metaconfig.py
+# inside that repository, since the repository is the directory of the
+# script.
+#
+# Licence: MIT, see metaconfig.py
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import metaconfig
+
+class RepoTestCase(unittest.TestCase):
+  """Creates a repository, a home directory and a state directory."""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp(prefix = "metaconfig-test-")
+    self.repo = os.path.join(self.root, "repo")
+    self.home = os.path.join(self.root, "home")
+    self.state = os.path.join(self.root, "state")
+    os.makedirs(self.repo)
+    os.makedirs(self.home)
+    shutil.copy(metaconfig.__file__, os.path.join(self.repo, "metaconfig.py"))
+    self.old_home = os.environ.get("HOME")
+    os.environ["HOME"] = self.home
+
+  def tearDown(self):
+    if self.old_home is None:
+      del os.environ["HOME"]
+    else:
+      os.environ["HOME"] = self.old_home
+    shutil.rmtree(self.root, ignore_errors = True)
+
+  def addModule(self, name, files, config = "location: ~/\n"):
+    """Creates a module with files, a dict of names and contents."""
+    path = os.path.join(self.repo, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "metaconfig.yaml"), "w") as stream:
+      stream.write(config)
+    for filename, contents in files.items():
+      write(os.path.join(path, filename), contents)
+    return path
+
+  def run_metaconfig(self, *args):
+    """Runs the copy of metaconfig.py in the repository non-interactively.
+
+    @return: The exit code.
+    """
+    process = subprocess.run([sys.executable,
+      os.path.join(self.repo, "metaconfig.py"), "--non-interactive",
+      "--state-dir", self.state] + list(args), cwd = self.root,
+      env = dict(os.environ, HOME = self.home), stdin = subprocess.DEVNULL,
+      stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+      universal_newlines = True)
+    self.output = process.stdout + process.stderr
+    return process.returncode
+
+def write(path, contents):
+  with open(path, "w") as stream:
+    stream.write(contents)
+
+def read(path):
+  with open(path, "r") as stream:
+    return stream.read()
+
+class RollbackTest(RepoTestCase):
+
+  def test_install_and_rollback(self):
+    module = self.addModule("m", {"f1": "new 1", "f2": "new 2"})
+    write(os.path.join(self.home, "f1"), "old 1")
+
+    self.assertEqual(self.run_metaconfig(), 0, self.output)
+    for name in ["f1", "f2"]:
+      self.assertEqual(os.readlink(os.path.join(self.home, name)),
+        os.path.join(module, name))
+
+    self.assertEqual(self.run_metaconfig("--rollback"), 0, self.output)
+    path = os.path.join(self.home, "f1")
+    self.assertFalse(os.path.islink(path))
+    self.assertEqual(read(path), "old 1")
+    self.assertFalse(os.path.lexists(os.path.join(self.home, "f2")))
+
+    # The journal can only be rolled back once.
+    self.assertEqual(self.run_metaconfig("--rollback"), 1, self.output)
+
+  def test_run_without_changes_keeps_journal(self):
+    self.addModule("m", {"f1": "new 1"})
+    write(os.path.join(self.home, "f1"), "old 1")
+    self.assertEqual(self.run_metaconfig(), 0, self.output)
+    self.assertEqual(self.run_metaconfig(), 0, self.output)
+
+    self.assertEqual(self.run_metaconfig("--rollback"), 0, self.output)
+    self.assertEqual(read(os.path.join(self.home, "f1")), "old 1")
+
+class BackupStoreTest(RepoTestCase):
+
+  def test_add_and_restore(self):
+    tree = os.path.join(self.home, "tree")
+    os.makedirs(os.path.join(tree, "sub"))
+    write(os.path.join(tree, "a"), "a")
+    write(os.path.join(tree, "sub", "b"), "b")
+    os.symlink("a", os.path.join(tree, "link"))
+    store = metaconfig.BackupStore(os.path.join(self.state, "store"),
+      metaconfig.HashCache())
+
+    record = store.add(tree)
+    store.finish()
+    # The original is left in place.
+    self.assertEqual(read(os.path.join(tree, "sub", "b")), "b")
+    self.assertEqual(store.latest(tree), record)
+
+    restored = os.path.join(self.root, "restored")
+    store.load().restore(store.latest(tree), restored)
+    self.assertTrue(metaconfig.compareDirs(tree, restored))
+    self.assertEqual(os.readlink(os.path.join(restored, "link")), "a")
+
+  def test_failed_add_leaves_nothing(self):
+    tree = os.path.join(self.home, "tree")
+    os.makedirs(tree)
+    for name in ["a", "b"]:
+      write(os.path.join(tree, name), name)
+    store = metaconfig.BackupStore(os.path.join(self.state, "store"),
+      metaconfig.HashCache())
+    add_file = store.addFile
+    def failing(path, st, staged):
+      if path.endswith("b"):
+        raise OSError("no space left")
+      return add_file(path, st, staged)
+    store.addFile = failing
+
+    with self.assertRaises(OSError):
+      store.add(tree)
+    store.finish()
+    self.assertIsNone(store.latest(tree))
+    self.assertEqual(os.listdir(os.path.join(self.state, "store", "objects")),
+      [])
+    self.assertEqual(sorted(os.listdir(tree)), ["a", "b"])
+
+  def test_keep_backups_with_jobs(self):
+    files = {"f%03d" % i: "new %d" % i for i in range(100)}
+    self.addModule("m", files)
+    for generation in range(3):
+      for name in files:
+        path = os.path.join(self.home, name)
+        if os.path.lexists(path):
+          os.remove(path)
+        write(path, "old %s %d" % (name, generation))
+      self.assertEqual(self.run_metaconfig("--backup-store",
+        "--keep-backups", "1", "-j", "16"), 0, self.output)
+
+    store = metaconfig.BackupStore(os.path.join(self.state, "store"),
+      metaconfig.HashCache()).load()
+    self.assertEqual(len(store.backups), len(files))
+    for path, records in store.backups.items():
+      self.assertEqual(len(records), 1)
+      self.assertTrue(os.path.exists(store.objectPath(records[0]["digest"])),
+        path)
+
+    path = os.path.join(self.home, "f042")
+    self.assertEqual(self.run_metaconfig("--restore", path), 0, self.output)
+    self.assertEqual(read(path), "old f042 2")
+
+class LibraryTest(RepoTestCase):
+
+  def test_plan_and_apply_relative_repo(self):
+    module = self.addModule("vim", {"vimrc": "set nocompatible"})
+    os.makedirs(os.path.join(module, "plugins"))
+    write(os.path.join(module, "plugins", "plugin.vim"), "\" plugin")
+
+    cwd = os.getcwd()
+    os.chdir(self.repo)
+    try:
+      plan = metaconfig.plan(".", state_dir = self.state)
+      results = metaconfig.apply(plan, state_dir = self.state)
+    finally:
+      os.chdir(cwd)
+
+    self.assertEqual(results, ["ok", "ok"])
+    for name in ["vimrc", "plugins"]:
+      path = os.path.join(self.home, name)
+      self.assertEqual(os.readlink(path), os.path.join(module, name))
+      self.assertTrue(os.path.exists(path))
+    statuses = [link[-1] for link in metaconfig.verify(self.repo,
+      state_dir = self.state)]
+    self.assertEqual(statuses, [metaconfig.LINK_CORRECT] * 2)
+
+if __name__ == "__main__":
+  unittest.main()